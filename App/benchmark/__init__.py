@@ -0,0 +1,8 @@
+"""
+Load test and benchmark suite for the flask routes.
+
+Seeds a throwaway setup (config, database, blogs) in a temporary directory and
+drives the routes through the flask test client and a real socket server.
+
+    python3 -m benchmark --help
+"""
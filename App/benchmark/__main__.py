@@ -0,0 +1,92 @@
+from argparse import ArgumentParser
+from json import dump, load
+from logging import getLogger, ERROR
+from os import chdir
+from os.path import abspath, dirname, exists
+from resource import getrusage, RUSAGE_SELF
+from shutil import rmtree
+from tempfile import mkdtemp
+import atexit
+import sys
+
+APP_DIR = dirname(dirname(abspath(__file__)))
+
+
+def main() -> int:
+    parser = ArgumentParser(
+        prog='python3 -m benchmark',
+        epilog='Runs offline against a throwaway setup in a temporary directory.',
+    )
+    parser.add_argument('--users',       type=int, default=200, help='seeded users')
+    parser.add_argument('--sessions',    type=int, default=100, help='seeded sessions, logins use users without a session')
+    parser.add_argument('--blogs',       type=int, default=1000, help='seeded blogs')
+    parser.add_argument('--words',       type=int, default=600, help='words per seeded blog')
+    parser.add_argument('--requests',    type=int, default=200, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients against the socket server')
+    parser.add_argument('--scenarios',   nargs='+', default=None, help='scenarios to run (default: all)')
+    parser.add_argument('--mode',        choices=('client', 'socket', 'both'), default='both', help='test client, socket server or both')
+    parser.add_argument('--rounds',      type=int, default=None, help='bcrypt cost of the setup, lower it for faster login runs')
+    parser.add_argument('--seed',        type=int, default=0, help='seed for generated data and requests')
+    parser.add_argument('--baseline',    default=None, help='compare with results stored in this json file')
+    parser.add_argument('--save',        default=None, help='store results as json, e.g. as new baseline')
+    parser.add_argument('--tolerance',   type=float, default=0.2, help='allowed regression against the baseline (0.2 = 20%%)')
+    parser.add_argument('--keep',        action='store_true', default=False, help='keep temporary directory')
+    args = parser.parse_args()
+    # result files are relative to where the benchmark was started, not to the temporary directory
+    if args.save is not None: args.save = abspath(args.save)
+    if args.baseline is not None: args.baseline = abspath(args.baseline)
+
+    # throwaway setup, the application works relative to the current directory
+    directory = mkdtemp(prefix='webapp-bench-')
+    sys.path.insert(0, APP_DIR)
+    from benchmark.seed import prepare, seed
+    from benchmark.runner import SCENARIOS, run_client, run_socket, compare
+    prepare(directory, APP_DIR)
+    chdir(directory)
+    with open('config.json', 'r') as f: config = load(f)
+    if args.rounds is not None: config.setdefault('bcrypt', dict())['rounds'] = args.rounds
+    # logins of the benchmark come from one address for a few accounts
+    config['limits'].update({'ip': {'rate': 1e6, 'burst': 1e6}, 'email': {'rate': 1e6, 'burst': 1e6}})
+    with open('config.json', 'w') as f: dump(config, f, indent=4)
+    getLogger('werkzeug').setLevel(ERROR) # no access log of the socket server
+
+    try:
+        print(f'seeding {args.users} users, {args.sessions} sessions and {args.blogs} blogs in {directory}')
+        fixture = seed(args.users, args.sessions, args.blogs, args.words, args.seed)
+        from src.backend import app
+        from src.metrics import metrics
+        atexit.unregister(metrics.flush) # the directory is gone by then
+
+        scenarios = args.scenarios or SCENARIOS
+        results = dict()
+        if args.mode in ('client', 'both'):
+            results['client'] = run_client(app, fixture, scenarios, args.requests, args.seed)
+        if args.mode in ('socket', 'both'):
+            results['socket'] = run_socket(app, fixture, scenarios, args.requests, args.concurrency, args.seed)
+        results['peak_rss_kb'] = getrusage(RUSAGE_SELF).ru_maxrss
+
+        # report
+        print(f'\n{"mode":<8} {"scenario":<16} {"requests":>8} {"errors":>6} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"req/s":>9}')
+        for mode in ('client', 'socket'):
+            for scenario, s in results.get(mode, {}).items():
+                print(f'{mode:<8} {scenario:<16} {s["requests"]:>8} {s["errors"]:>6} {s["p50"]:>9.2f} {s["p95"]:>9.2f} {s["p99"]:>9.2f} {s["rps"]:>9.1f}')
+        print(f'\npeak rss: {results["peak_rss_kb"] / 1024:.1f} MiB')
+
+        if args.save is not None:
+            with open(args.save, 'w') as f: dump(results, f, indent=4)
+        if args.baseline is not None:
+            if not exists(args.baseline):
+                print(f'baseline not found: {args.baseline}')
+                return 1
+            with open(args.baseline, 'r') as f:
+                regressions = compare(results, load(f), args.tolerance)
+            for i in regressions: print(f'regression: {i}')
+            if regressions: return 1
+            print('no regressions against baseline')
+        return 0
+    finally:
+        if not args.keep: rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    exit(main())
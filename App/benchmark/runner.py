@@ -0,0 +1,140 @@
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+from itertools import count
+from math import ceil
+from random import Random
+from threading import Thread
+from time import perf_counter
+from urllib.parse import quote, urlencode
+from werkzeug.serving import make_server
+
+SCENARIOS = ('explore_random', 'explore_search', 'explore_read', 'profile', 'login', 'blog_write')
+EXPECTED_STATUS = {'login': 302, 'blog_write': 200} # others only have to succeed
+ERROR_PAGE = b'<title>Error</title>' # the app renders most failures as error.html with status 200
+
+
+class Requests:
+    def __init__(self, fixture:dict, seed:int = 0, mode:str = 'client') -> None:
+        """Build reproducible requests for the scenarios from the seeded data, mode keeps titles of written blogs apart between runs."""
+        self.fixture = fixture
+        self.mode = mode
+        self.rnd = Random(seed)
+        self.counter = count()
+
+
+    def make(self, scenario:str) -> tuple:
+        """Return (method, path, form data, session) of the next request."""
+        f, rnd = self.fixture, self.rnd
+        match scenario:
+            case 'explore_random':  return 'GET', '/explore', None, None
+            case 'explore_search':
+                search = rnd.choice(f['words']) if rnd.random() < 0.5 else f'#{rnd.choice(f["tags"])}'
+                return 'GET', f'/explore?search={quote(search)}', None, None
+            case 'explore_read':    return 'GET', f'/explore?blog={quote(rnd.choice(f["blogs"]))}', None, None
+            case 'profile':         return 'GET', '/profile', None, rnd.choice(f['sessions'])
+            case 'login':           return 'POST', '/login', {'email': rnd.choice(f['login_emails']), 'password': f['password']}, None
+            case 'blog_write':
+                return 'POST', '/blog/write', {
+                    'title': f'Bench {self.mode} post {next(self.counter)}',
+                    'tags': ','.join(rnd.sample(f['tags'], 2)),
+                    'blog': ' '.join(rnd.choice(f['words']) for _ in range(300)),
+                }, rnd.choice(f['sessions'])
+            case _: raise ValueError(f'unknown scenario: {scenario}')
+
+
+def percentile(values:list, p:float) -> float:
+    """Nearest rank percentile of sorted values."""
+    if not values: return 0.0
+    return values[min(len(values) - 1, max(0, ceil(p / 100 * len(values)) - 1))]
+
+
+def failed(scenario:str, status:int, body:bytes) -> bool:
+    """Return True if the response isn't the one expected for scenario."""
+    if status >= 400 or status != EXPECTED_STATUS.get(scenario, status): return True
+    return ERROR_PAGE in body
+
+
+def summarize(latencies:list, elapsed:float, errors:int) -> dict:
+    """Latency percentiles in ms and requests per second."""
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50': percentile(latencies, 50) * 1000,
+        'p95': percentile(latencies, 95) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'rps': len(latencies) / elapsed if elapsed else 0.0,
+    }
+
+
+def run_client(app, fixture:dict, scenarios:tuple|list, n:int, seed:int = 0) -> dict:
+    """Run scenarios one request after another through the flask test client."""
+    requests = Requests(fixture, seed, 'client')
+    client = app.test_client()
+    results = dict()
+    for scenario in scenarios:
+        latencies, errors = [], 0
+        start = perf_counter()
+        for _ in range(n):
+            method, path, data, session = requests.make(scenario)
+            if session is not None: client.set_cookie('session', session)
+            else: client.delete_cookie('session')
+            t = perf_counter()
+            response = client.open(path, method=method, data=data)
+            latencies.append(perf_counter() - t)
+            if failed(scenario, response.status_code, response.get_data()): errors += 1
+            response.close()
+        results[scenario] = summarize(latencies, perf_counter() - start, errors)
+    return results
+
+
+def _send(host:str, port:int, scenario:str, request:tuple) -> tuple:
+    """Send request over a new connection, returns (seconds, failed)."""
+    method, path, data, session = request
+    headers = {'Cookie': f'session={session}'} if session is not None else dict()
+    body = None
+    if data is not None:
+        body = urlencode(data)
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    start = perf_counter()
+    conn = HTTPConnection(host, port, timeout=30)
+    try:
+        conn.request(method, path, body, headers)
+        response = conn.getresponse()
+        body = response.read()
+        return perf_counter() - start, failed(scenario, response.status, body)
+    finally: conn.close()
+
+
+def run_socket(app, fixture:dict, scenarios:tuple|list, n:int, concurrency:int, seed:int = 0) -> dict:
+    """Run scenarios through a threaded socket server with concurrent clients."""
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    requests = Requests(fixture, seed, 'socket')
+    results = dict()
+    try:
+        with ThreadPoolExecutor(concurrency) as pool:
+            for scenario in scenarios:
+                batch = [requests.make(scenario) for _ in range(n)]
+                start = perf_counter()
+                done = list(pool.map(lambda r: _send('127.0.0.1', server.server_port, scenario, r), batch))
+                results[scenario] = summarize([i[0] for i in done], perf_counter() - start, sum(1 for i in done if i[1]))
+    finally:
+        server.shutdown()
+    return results
+
+
+def compare(results:dict, baseline:dict, tolerance:float) -> list:
+    """Return regressions against baseline, p95 may grow and rps may drop by tolerance (0.2 = 20%)."""
+    regressions = []
+    for mode, scenarios in results.items():
+        if not isinstance(scenarios, dict): continue
+        for scenario, stats in scenarios.items():
+            old = baseline.get(mode, {}).get(scenario)
+            if old is None: continue
+            if stats['p95'] > old['p95'] * (1 + tolerance):
+                regressions.append(f'{mode} {scenario}: p95 {old["p95"]:.2f} ms -> {stats["p95"]:.2f} ms')
+            if stats['rps'] < old['rps'] * (1 - tolerance):
+                regressions.append(f'{mode} {scenario}: rps {old["rps"]:.1f} -> {stats["rps"]:.1f}')
+    return regressions
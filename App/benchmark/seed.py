@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta
+from hashlib import sha256
+from os import mkdir
+from os.path import exists
+from random import Random
+from subprocess import run
+from sys import executable
+
+WORDS = (
+    'python', 'flask', 'sqlite', 'docker', 'linux', 'cache', 'index', 'thread', 'process', 'async',
+    'network', 'socket', 'latency', 'memory', 'profile', 'compiler', 'kernel', 'rust', 'template', 'query',
+    'cat', 'blog', 'server', 'client', 'design', 'review', 'deploy', 'cloud', 'storage', 'search',
+)
+TAGS = ('python', 'web', 'db', 'ops', 'rust', 'linux', 'cats', 'perf', 'security', 'howto')
+PASSWORD = 'benchmark'
+
+
+def prepare(directory:str, app_dir:str) -> None:
+    """Run the regular setup of the application in directory."""
+    for i in ('static', 'static/img', 'static/img/profiles'):
+        if not exists(f'{directory}/{i}'): mkdir(f'{directory}/{i}')
+    run([executable, f'{app_dir}/run.py', '--setup'], cwd=directory, check=True, capture_output=True)
+
+
+def _text(rnd:Random, words:int) -> str:
+    """Random markdown with headings and paragraphs."""
+    paragraphs = []
+    while words > 0:
+        n = min(words, rnd.randint(30, 90))
+        paragraphs.append(' '.join(rnd.choice(WORDS) for _ in range(n)).capitalize() + '.')
+        words -= n
+    return '\n\n'.join(f'## {rnd.choice(WORDS).title()}\n\n{p}' if i % 3 == 0 else p for i, p in enumerate(paragraphs))
+
+
+def seed(users:int, sessions:int, blogs:int, words:int = 600, seed:int = 0) -> dict:
+    """
+    Fill database and blog directory of the current working directory.
+    Returns the data needed to build requests.
+    """
+    from src.sql import DB
+    from src.hashing import hasher
+    from src.functions import fill_search_index, fill_tag_index, DB_PATH, TABLES
+    from src.storage import storage
+
+    rnd = Random(seed)
+    password = hasher.hash(PASSWORD) # hashing once keeps seeding fast, logins still pay for bcrypt
+    uids = [sha256(f'benchmark{i}'.encode()).hexdigest() for i in range(users)]
+    expires = datetime.now() + timedelta(days=1)
+
+    db = DB(DB_PATH)
+    db.conn.executemany(
+        f'INSERT INTO {TABLES["user-data"]} (unique_id, firstname, lastname, email, username, password) VALUES (?, ?, ?, ?, ?, ?);',
+        ((uid, 'Bench', f'User{i}', f'user{i}@bench.local', f'user{i}', password) for i, uid in enumerate(uids))
+    )
+    db.conn.executemany(
+        f'INSERT INTO {TABLES["session"]} (unique_id, session_id, expiration, username, email, realname) VALUES (?, ?, ?, ?, ?, ?);',
+        ((uids[i], f'benchsession{i:08d}', expires, f'user{i}', f'user{i}@bench.local', f'Bench User{i}') for i in range(min(sessions, users)))
+    )
+    blog_ids = []
+    rows = []
+    for i in range(blogs):
+        author = rnd.randrange(users)
+        uid = uids[author]
+        title = f'Blog {i} {rnd.choice(WORDS)}'
+        storage.write(f'{uid}_{title}', f'# {title}\n\n' + _text(rnd, words))
+        rows.append((uid, f'user{author}', title, ','.join(rnd.sample(TAGS, 2))))
+        blog_ids.append(f'{uid}_{title}')
+    db.conn.executemany(f'INSERT INTO {TABLES["blog"]} (unique_id, username, title, tags) VALUES (?, ?, ?, ?);', rows)
+    fill_search_index(db)
+    fill_tag_index(db)
+    db.close()
+
+    return {
+        'sessions': [f'benchsession{i:08d}' for i in range(min(sessions, users))],
+        'login_emails': [f'user{i}@bench.local' for i in range(min(sessions, users), users)] or [f'user{i}@bench.local' for i in range(users)],
+        'password': PASSWORD,
+        'blogs': blog_ids,
+        'words': list(WORDS),
+        'tags': list(TAGS),
+    }
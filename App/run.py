@@ -1,9 +1,11 @@
 from argparse import ArgumentParser
 from json import dump, load, JSONDecodeError
-from src.logger import Logger
+from src.logger import Logger, writer
 from os.path import exists
-from os import remove, mkdir, listdir
+from os import remove, mkdir, listdir, walk
+from shutil import rmtree
 from multiprocessing import Process
+from threading import Thread
 from secrets import token_hex
 
 log = Logger('RunLog')
@@ -16,25 +18,79 @@ except (JSONDecodeError, FileNotFoundError):
     log.warning('failed to load config file')
     CONFIG:dict = dict()
 
+# log output of all loggers
+writer.configure(
+    CONFIG.get('log', {}).get('format', 'text'),
+    CONFIG.get('log', {}).get('file'),
+    CONFIG.get('log', {}).get('max_bytes', 10485760),
+    CONFIG.get('log', {}).get('backups', 5)
+)
+
 
 def run() -> None:
     """Run the application."""
     try:
         from src.backend import app
         from src.session import session_cleanup
+        from src.metrics import metrics
         
+        # update database schema
+        if CONFIG.get('db').get('auto_migrate', True): migrate()
+
+        # metrics of a previous run
+        metrics.clear_directory()
+
         # flask configurations
         app.config.update(
             SESSION_COOKIE_SAMESITE = True,
             SECRET_KEY=CONFIG.get('secret_key').encode()
         )
 
-        # start session cleanup thread
-        log.debug('starting session cleanup thread')
+        # run application
+        if CONFIG.get('run').get('asgi', {}).get('enabled', False) and not args['debug']:
+            try: import uvicorn
+            except ImportError:
+                log.warning('uvicorn isn\'t installed, falling back to the wsgi server')
+            else:
+                log.info('starting asgi server')
+                Thread(target=session_cleanup, args=(CONFIG.get('vars')['session_cleanup'], ), daemon=True).start()
+                uvicorn.run(
+                    'src.asgi:app',
+                    host=CONFIG.get('run')['address'],
+                    port=CONFIG.get('run')['port'],
+                    workers=CONFIG.get('run').get('workers', 4),
+                    backlog=CONFIG.get('run').get('backlog', 2048),
+                    timeout_keep_alive=CONFIG.get('run').get('keepalive', 5),
+                    timeout_graceful_shutdown=CONFIG.get('run').get('graceful_timeout', 30),
+                    log_level='warning',
+                )
+                return
+
+        if CONFIG.get('run').get('production', False) and not args['debug']:
+            try: from src.server import ProductionServer
+            except ImportError: # gunicorn only runs on unix
+                log.warning('production server not available, falling back to flask')
+            else:
+                log.info('starting production server')
+                ProductionServer(app, {
+                    'bind': f"{CONFIG.get('run')['address']}:{CONFIG.get('run')['port']}",
+                    'worker_class': 'gthread',
+                    'workers': CONFIG.get('run').get('workers', 4),
+                    'threads': CONFIG.get('run').get('threads', 8),
+                    'backlog': CONFIG.get('run').get('backlog', 2048),
+                    'keepalive': CONFIG.get('run').get('keepalive', 5),
+                    'timeout': CONFIG.get('run').get('timeout', 30),
+                    'graceful_timeout': CONFIG.get('run').get('graceful_timeout', 30), # drain time on SIGTERM
+                }, on_ready=lambda: Thread( # session cleanup runs in the master, forked workers don't inherit threads
+                    target=session_cleanup, args=(CONFIG.get('vars')['session_cleanup'], ), daemon=True
+                ).start()).run()
+                return
+
+        # start session cleanup process
+        log.debug('starting session cleanup process')
         session_clean_proc = Process(target=session_cleanup, args=(CONFIG.get('vars')['session_cleanup'], ))
         session_clean_proc.start()
 
-        # run application
         log.info('starting flask')
         app.run(
             host=CONFIG.get('run')['address'], 
@@ -56,7 +112,8 @@ def cleanup() -> None:
 
     # clean up blogs
     try: 
-        tuple(map(lambda x: remove(f'./static/blogs/{x}'), listdir('./static/blogs')))
+        rmtree(CONFIG.get('storage', {}).get('path', 'data/blogs'), ignore_errors=True)
+        tuple(map(lambda x: remove(f'./static/blogs/{x}'), listdir('./static/blogs'))) if exists('./static/blogs') else ... # legacy layout
         log.debug('deleting blogs')
     except Exception as e: 
         log.warning(f'exception caught at deleting blogs: {e.__str__()}')
@@ -71,11 +128,29 @@ def cleanup() -> None:
     # clean up database
     try: 
         remove(CONFIG.get('db')['path'])
+        for i in ('-wal', '-shm'): # journal files of wal mode
+            if exists(CONFIG.get('db')['path'] + i): remove(CONFIG.get('db')['path'] + i)
+        if exists(CONFIG.get('limits', {}).get('path', 'db/login_limits')): remove(CONFIG.get('limits', {}).get('path', 'db/login_limits'))
+        if exists(CONFIG.get('cache', {}).get('session', {}).get('generation_path', 'db/session_generation')): remove(CONFIG.get('cache', {}).get('session', {}).get('generation_path', 'db/session_generation'))
         log.debug('deleting database')
     except Exception as e: 
         if e.__str__() != "'NoneType' object is not subscriptable":
             log.warning(f'exception caught at deleting db: {e.__str__()}')
 
+    # clean up precompressed static files
+    try: 
+        tuple(remove(f'{root}/{x}') for root, _, files in walk('./static') for x in files if x.endswith(('.gz', '.br')))
+        log.debug('deleting precompressed static files')
+    except Exception as e: 
+        log.warning(f'exception caught at deleting precompressed static files: {e.__str__()}')
+
+    # clean up metrics
+    try: 
+        tuple(map(lambda x: remove(f'./metrics/{x}'), listdir('./metrics'))) if exists('./metrics') else ...
+        log.debug('deleting metrics')
+    except Exception as e: 
+        log.warning(f'exception caught at deleting metrics: {e.__str__()}')
+
     # clean up configs
     try: 
         remove('./config.json')
@@ -98,19 +173,118 @@ def setup() -> None:
             'tables': {
                 'user-data': 'users',
                 'session': 'sessions',
-                'blog': 'blogs'
+                'blog': 'blogs',
+                'search': 'blogs_fts',
+                'tag': 'blog_tags',
+                'tag_count': 'tag_counts'
+            },
+            'auto_migrate': True,
+            'slow_query_ms': 100,
+            'slow_query_log': 'db/slow_queries.log',
+            'writer': {
+                'window_ms': 2,
+                'max_batch': 64
+            },
+            'pool': {
+                'max_idle': 8
+            },
+            'pragmas': {
+                'journal_mode': 'wal',
+                'synchronous': 'normal',
+                'cache_size': -16000,
+                'busy_timeout': 5000
             }
         },
         'vars': {
             'cookie_livetime': 43200,
-            'session_cleanup': 600
+            'session_cleanup': 600,
+            'session_cleanup_batch': 500,
+            'session_cleanup_pause': 0.05,
+            'search_page_size': 20,
+            'profile_page_size': 20,
+            'explore_sample_size': 5
+        },
+        'cache': {
+            'session': {
+                'max_size': 1024,
+                'ttl': 60,
+                'generation_path': 'db/session_generation',
+                'generation_slots': 16384
+            },
+            'blog_html': {
+                'max_bytes': 33554432
+            },
+            'tags': {
+                'max_size': 16,
+                'ttl': 30
+            }
+        },
+        'bcrypt': {
+            'rounds': 12,
+            'workers': 2,
+            'max_queue': 32
+        },
+        'limits': {
+            'path': 'db/login_limits',
+            'slots': 4096,
+            'ip': {
+                'rate': 0.5,
+                'burst': 10
+            },
+            'email': {
+                'rate': 0.1,
+                'burst': 5
+            }
+        },
+        'import': {
+            'batch_size': 500,
+            'processes': None
+        },
+        'storage': {
+            'path': 'data/blogs',
+            'depth': 2,
+            'compress': False
+        },
+        'compression': {
+            'min_size': 1024,
+            'gzip_level': 6,
+            'brotli_quality': 5
+        },
+        'img': {
+            'sizes': [96, 192, 384],
+            'quality': 80,
+            'processes': 2
+        },
+        'metrics': {
+            'dir': 'metrics',
+            'allow': ['127.0.0.1'],
+            'buckets': [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5],
+            'flush_interval': 1
         },
         'run': {
             'address': '0.0.0.0',
-            'port': 8080
+            'port': 8080,
+            'production': True,
+            'workers': 4,
+            'threads': 8,
+            'backlog': 2048,
+            'keepalive': 5,
+            'timeout': 30,
+            'graceful_timeout': 30,
+            'asgi': {
+                'enabled': False,
+                'read_threads': 32,
+                'write_threads': 4,
+                'max_pending': 1024,
+                'max_body': 16777216
+            }
         },
         'log': {
-            'remove':['debug'] if args['debug'] is False else []
+            'remove':['debug'] if args['debug'] is False else [],
+            'format': 'text',
+            'file': None,
+            'max_bytes': 10485760,
+            'backups': 5
         }
     })
 
@@ -162,14 +336,17 @@ def setup() -> None:
             'tags text'
         )
     )
-    db.close()
+    migrate() # indexes and search index
     log.info('db setup complete')
     
     # blogs
-    if not exists('./static/blogs'): mkdir('./static/blogs')
-    if not exists('./static/blogs/noblock_noblock.md'):
-        with open('./static/blogs/noblock_noblock.md', 'w') as f:
-            f.write('# Empty Blog\n\nYou will see this if no block is registered in the database.')
+    from src.storage import storage
+    if not storage.exists('noblock_noblock'):
+        storage.write('noblock_noblock', '# Empty Blog\n\nYou will see this if no block is registered in the database.')
+
+    # precompressed static files
+    from src.compression import compressor
+    compressor.precompress('./static')
 
     # info
     log.info('setup successful, you can edit the configs in config.json')
@@ -177,7 +354,8 @@ def setup() -> None:
 
 def sql() -> None:
     """SQL terminal to interact directly with the database."""
-    from src.sql import DB
+    from src.sql import DB, QueryStats
+    from src.metrics import metrics
 
     # check if database exist
     if not exists(CONFIG.get('db')['path']):
@@ -186,15 +364,58 @@ def sql() -> None:
 
     # start database terminal
     db = DB(CONFIG.get('db')['path'])
-    print('You can execute commands on the database now.\bTo exit press: [ctrl] + [C]')
+    print('You can execute commands on the database now.\nType .report for query stats of the running application.\nTo exit press: [ctrl] + [C]')
     try:
         while True:
-            try: print(f'[-]> {db.execute(input("[+]> "))}')
+            try: 
+                code = input("[+]> ")
+                if code.strip() == '.report': print(QueryStats.report(metrics.collect('sql')))
+                else: print(f'[-]> {db.execute(code)}')
             except Exception: continue
     except KeyboardInterrupt:
         db.close()
 
 
+def reindex() -> None:
+    """Rebuild search index from the blog files."""
+    migrate() # makes sure the search index exists
+    from src.functions import rebuild_search_index
+    rebuild_search_index()
+
+
+def import_data(directory:str) -> None:
+    """Bulk import users and blogs from directory."""
+    migrate() # makes sure the search index exists
+    from src.importer import import_data as run_import
+
+    if not exists(directory):
+        log.error(f'import directory doesn\'t exist: {directory}')
+        exit(1)
+    run_import(directory)
+
+
+def migrate_storage() -> None:
+    """Move blog files of the flat static/blogs layout into the blog storage."""
+    from src.storage import storage
+    storage.migrate_legacy()
+
+
+def migrate() -> None:
+    """Apply pending schema migrations."""
+    from src.sql import DB
+    from src.migrations import migrate as apply_migrations
+
+    # check if database exist
+    if not exists(CONFIG.get('db')['path']):
+        log.error(f'database doesn\'t exist: {CONFIG.get("db")["path"]}')
+        exit(1)
+
+    db = DB(CONFIG.get('db')['path'])
+    applied = apply_migrations(db)
+    db.close()
+    log.info(f'applied {applied} migrations' if applied else 'database is up to date')
+
+
 if __name__ == '__main__':
     parser = ArgumentParser(
         usage='python3 run.py [options]',
@@ -204,6 +425,10 @@ if __name__ == '__main__':
     parser.add_argument('--cleanup',    action='store_true', default=False, help='clean up everything for a clean and fresh new setup')
     parser.add_argument('--setup',      action='store_true', default=False, help='setup db and configs')
     parser.add_argument('--sql',        action='store_true', default=False, help='start interactive interface for db')
+    parser.add_argument('--migrate',    action='store_true', default=False, help='apply pending database migrations')
+    parser.add_argument('--migrate-storage', action='store_true', default=False, help='move blog files from static/blogs into the blog storage')
+    parser.add_argument('--reindex',    action='store_true', default=False, help='rebuild search index from blog files')
+    parser.add_argument('--import',     metavar='DIR', default=None, help='bulk import users.csv and blogs/*.md from DIR')
     parser.add_argument('--debug',      action='store_true', default=False, help='activate debugging')
     args = vars(parser.parse_args()) # parse args and convert to dict
 
@@ -211,13 +436,17 @@ if __name__ == '__main__':
     if not args['debug']: log.remove_loglist('debug')
     if exists('./config.json'):
         with open('./config.json', 'w') as f:
-            CONFIG.update({'log':{'remove':['debug'] if args['debug'] is False else []}})
+            CONFIG.setdefault('log', dict()).update({'remove':['debug'] if args['debug'] is False else []})
             dump(CONFIG, f, indent=4)
 
     if args.get('run'):     run()
     if args.get('cleanup'): cleanup()
     if args.get('setup'):   setup()
     if args.get('sql'):     sql()
+    if args.get('migrate'): migrate()
+    if args.get('migrate_storage'): migrate_storage()
+    if args.get('reindex'): reindex()
+    if args.get('import'):  import_data(args['import'])
 
 
 # TODO: is revealing session cookies and user credentials in the logs bad practice?
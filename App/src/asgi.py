@@ -0,0 +1,138 @@
+from src.logger import Logger
+from src.exception import JSONDecodeError
+from src.backend import app as flask_app
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from sys import stderr
+import asyncio
+
+log = Logger('AsgiLog')
+
+try:
+    with open('./config.json', 'r') as f:
+        CONFIG:dict = __import__('json').load(f)
+except JSONDecodeError:
+    log.critical('failed to load config file')
+    exit(1)
+
+# update loglist
+log.remove_loglist(*CONFIG.get('log')['remove'])
+
+ASGI = CONFIG.get('run', {}).get('asgi', {})
+
+
+class AsgiApp:
+    def __init__(self, wsgi_app, read_threads:int = 32, write_threads:int = 4, max_pending:int = 1024, max_body:int = 16 * 1024 * 1024) -> None:
+        """
+        ASGI entry point, connections are handled on the event loop and only the views run on bounded thread pools.
+        Slow clients hold a coroutine instead of a thread, requests beyond max_pending are answered with 503.
+        """
+        self.wsgi_app = wsgi_app
+        self.max_body = max_body
+        self._read = ThreadPoolExecutor(read_threads, thread_name_prefix='asgi-read')
+        self._write = ThreadPoolExecutor(write_threads, thread_name_prefix='asgi-write') # form posts, logins hash with bcrypt, they can't starve page loads
+        self._max_pending = max_pending
+        self._pending = 0
+
+
+    async def __call__(self, scope:dict, receive, send) -> None:
+        if scope['type'] == 'lifespan': return await self._lifespan(receive, send)
+        if scope['type'] != 'http': return # no websockets
+
+        # read request body, the view gets it at once
+        body = BytesIO()
+        more = True
+        while more:
+            message = await receive()
+            if message['type'] == 'http.disconnect': return
+            body.write(message.get('body', b''))
+            more = message.get('more_body', False)
+            if body.tell() > self.max_body: return await self._respond(send, 413, [], b'Request Entity Too Large')
+
+        if self._pending >= self._max_pending:
+            log.warning('too many pending requests')
+            return await self._respond(send, 503, [(b'retry-after', b'1')], b'Service Unavailable')
+        read = scope['method'] in ('GET', 'HEAD') # pages and static files, form posts and logins go to the write pool
+        self._pending += 1
+        try:
+            status, headers, data = await asyncio.get_running_loop().run_in_executor(
+                self._read if read else self._write, self._run_view, self._environ(scope, body)
+            )
+        finally: self._pending -= 1
+        await self._respond(send, status, headers, data if scope['method'] != 'HEAD' else b'')
+
+
+    def _run_view(self, environ:dict) -> tuple:
+        """Call the flask app and read the whole response in the pool thread."""
+        response = dict()
+        def start_response(status:str, headers:list, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in headers]
+        result = self.wsgi_app(environ, start_response)
+        try: data = b''.join(result)
+        finally:
+            if hasattr(result, 'close'): result.close()
+        return response['status'], response['headers'], data
+
+
+    def _environ(self, scope:dict, body:BytesIO) -> dict:
+        """WSGI environ of ASGI request."""
+        body.seek(0)
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1] or 80),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for key, value in scope.get('headers', ()):
+            key = key.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'): environ[key] = value
+            elif f'HTTP_{key}' in environ: environ[f'HTTP_{key}'] += f',{value}'
+            else: environ[f'HTTP_{key}'] = value
+        return environ
+
+
+    async def _respond(self, send, status:int, headers:list, body:bytes) -> None:
+        """Send whole response."""
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+
+    async def _lifespan(self, receive, send) -> None:
+        """Shut the thread pools down with the server."""
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self._read.shutdown(wait=True)
+                self._write.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+flask_app.config.update( # same as run.py, workers of the server import this module on their own
+    SESSION_COOKIE_SAMESITE = True,
+    SECRET_KEY=CONFIG.get('secret_key').encode()
+)
+
+app = AsgiApp(
+    flask_app,
+    ASGI.get('read_threads', 32),
+    ASGI.get('write_threads', 4),
+    ASGI.get('max_pending', 1024),
+    ASGI.get('max_body', 16 * 1024 * 1024)
+)
@@ -1,16 +1,25 @@
-from flask import Flask, render_template, request, make_response, redirect
-from flask_bcrypt import Bcrypt
+from flask import Flask, render_template, request, make_response, redirect, g, abort, send_file, jsonify
+from werkzeug.http import is_resource_modified
+from werkzeug.security import safe_join
+from markupsafe import Markup
 from src.logger import Logger
-from src.sql import DB
-from src.exception import IntegrityError, NoSessionError, InvalidBlogIDError, JSONDecodeError, UserNotFoundError
-from src.session import add_session, get_session_data, remove_session
-from src.functions import save_profile_img, save_blog_post, save_blog_entry, load_blog_html, load_blog_plain, delete_blog_entry, delete_blog_post
+from src.sql import DB, pool, query_count, query_stats, QueryStats
+from src.exception import IntegrityError, NoSessionError, InvalidBlogIDError, JSONDecodeError, UserNotFoundError, HashQueueFullError
+from src.hashing import hasher
+from src.ratelimit import login_limiter
+from src.session import add_session, get_session_data, remove_session, session_cache
+from src.functions import save_profile_img, save_blog_post, save_blog_entry, load_blog_html, load_blog_plain, delete_blog_entry, delete_blog_post, search_blogs, profile_blogs, random_blogs, tag_counts, IMG_SIZES, html_cache, tag_cache
+from src.storage import storage
+from src.metrics import metrics
+from src.compression import compressor, STATIC_TYPES
 from hashlib import sha256
 from uuid import uuid4
 from datetime import datetime, timedelta
-from os.path import exists
-from random import choices
+from time import perf_counter
+from os.path import getmtime, join
+from os import listdir
 from urllib.parse import quote
+from mimetypes import guess_type
 
 log = Logger('FlaskLog')
 
@@ -28,13 +37,86 @@ log.remove_loglist(*CONFIG.get('log')['remove'])
 DB_PATH = CONFIG.get('db')['path']
 TABLES = CONFIG.get('db')['tables']
 COOKIE_LIFETIME = CONFIG.get('vars')['cookie_livetime'] # 86400 seconds = 24 hours
+METRICS_ALLOW = CONFIG.get('metrics', {}).get('allow', ['127.0.0.1'])
+LOGIN_LIMITS = { # tokens per second and burst size
+    'ip': CONFIG.get('limits', {}).get('ip', {'rate': 0.5, 'burst': 10}),
+    'email': CONFIG.get('limits', {}).get('email', {'rate': 0.1, 'burst': 5}),
+}
+if any(limit['rate'] <= 0 or limit['burst'] < 1 for limit in LOGIN_LIMITS.values()):
+    log.critical('login limits need a rate above 0 and a burst of at least 1')
+    exit(1)
 
 app = Flask(
     import_name=__name__,
     static_folder='../static/',
     template_folder='../templates/'
 )
-bcrypt = Bcrypt(app)
+TEMPLATES = join(app.root_path, app.template_folder)
+TEMPLATES_VERSION = max(getmtime(join(TEMPLATES, i)) for i in listdir(TEMPLATES)) # etags change with the templates
+
+
+@app.teardown_appcontext
+def release_db(exception) -> None:
+    """Give pooled db connections back at the end of each request."""
+    pool.release()
+
+
+# metrics
+metrics.sources.update({
+    'session_cache': session_cache.stats,
+    'blog_html_cache': html_cache.stats,
+    'tag_cache': tag_cache.stats,
+    'bcrypt': hasher.stats,
+    'login_limiter': login_limiter.stats,
+})
+metrics.reports['sql'] = query_stats.snapshot
+
+
+@app.before_request
+def start_metrics() -> None:
+    """Start timing request."""
+    metrics.start()
+    query_count(reset=True)
+    g.metrics_start = perf_counter()
+
+
+@app.after_request
+def record_metrics(response):
+    """Record latency, status and db queries of request."""
+    metrics.record(
+        request.url_rule.rule if request.url_rule is not None else 'unmatched', 
+        request.method, response.status_code, 
+        perf_counter() - g.metrics_start, query_count()
+    )
+    return response
+
+
+@app.after_request
+def compress(response):
+    """Compress text responses if the client accepts it."""
+    return compressor.compress_response(response, request.accept_encodings)
+
+
+def static_file(filename:str):
+    """Static files, precompressed variants are sent if the client accepts them."""
+    path = safe_join(app.static_folder, filename)
+    variant = compressor.static_variant(path, request.accept_encodings) if path is not None else None
+    if variant is None: 
+        response = app.send_static_file(filename)
+    else:
+        response = send_file(variant[0], mimetype=guess_type(filename)[0], max_age=app.get_send_file_max_age(filename))
+        response.headers['Content-Encoding'] = variant[1]
+    if filename.endswith(STATIC_TYPES): response.vary.add('Accept-Encoding')
+    return response
+
+
+app.view_functions['static'] = static_file
+
+
+@app.teardown_request
+def finish_metrics(exception) -> None:
+    """Request isn't in flight anymore."""
+    metrics.finish()
 
 
 # flask paths
@@ -52,7 +134,7 @@ def signup() -> str:
     
     elif request.method == 'POST':
         # obtain post data and process it
-        password = bcrypt.generate_password_hash(request.form.get('password')).decode()
+        password = hasher.hash(request.form.get('password'))
         username = request.form.get('username')
         len_realname = len(request.form.get('realname').split())
         creds = {
@@ -85,6 +167,14 @@ def login() -> str:
         # obtain post data
         email = request.form.get('email')
         password = request.form.get('password')
+        # throttle guessing before any db or bcrypt work
+        wait = login_limiter.acquire( # tokens are only taken if both buckets have one
+            (f'ip:{request.remote_addr}', LOGIN_LIMITS['ip']['rate'], LOGIN_LIMITS['ip']['burst']),
+            (f'email:{str(email).strip().lower()}', LOGIN_LIMITS['email']['rate'], LOGIN_LIMITS['email']['burst'])
+        )
+        if wait:
+            log.debug(f'login throttled: {request.remote_addr}')
+            return error('Too Many Attempts', 'Too many login attempts, please try again later.', '/login'), 429, {'Retry-After': str(int(wait) + 1)}
         # obtain account data from db
         db = DB(DB_PATH)
         try: 
@@ -96,8 +186,14 @@ def login() -> str:
         db.close()
         # check password hash
         if password_hash is not None:
-            if bcrypt.check_password_hash(password_hash, password):
+            if hasher.check(password_hash, password):
                 log.debug('login succeed')
+                # rehash with current cost
+                if hasher.outdated(password_hash):
+                    db = DB(DB_PATH)
+                    db.update(TABLES['user-data'], {'password': hasher.hash(password)}, f'WHERE "{unique_id}" = unique_id')
+                    db.close()
+                    log.debug('password hash upgraded')
                 # generate and set session cookie
                 session = uuid4().hex
                 expires = datetime.now() + timedelta(seconds=COOKIE_LIFETIME)
@@ -136,6 +232,7 @@ def logout() -> redirect:
 def profile() -> str:
     """Profile path."""
     if request.method == 'GET':
+        img = (None, None) # extension and version of profile image
         try:
             if request.args.get('view'):
                 # view account
@@ -145,13 +242,13 @@ def profile() -> str:
                 db = DB(DB_PATH)
                 try:
                     # obtain data about account
-                    username, firstname, lastname, email = db.select(TABLES['user-data'], ('username', 'firstname', 'lastname', 'email'), f'WHERE unique_id="{unique_id}"')[0]
+                    username, firstname, lastname, email, *img = db.select(TABLES['user-data'], ('username', 'firstname', 'lastname', 'email', 'profile_img', 'profile_img_version'), f'WHERE unique_id="{unique_id}"')[0]
                     realname = f'{firstname} {lastname}'
                 except TypeError: raise UserNotFoundError
                 db.close()
             else:
                 # obtain session data
-                unique_id, username, email, realname = get_session_data(request.cookies.get('session'), ('unique_id', 'username', 'email', 'realname'))
+                unique_id, username, email, realname, *img = get_session_data(request.cookies.get('session'), ('unique_id', 'username', 'email', 'realname', 'profile_img', 'profile_img_version'))
 
         except UserNotFoundError:
             return error('User Not Found', 'The requested user wasn\'t found.')
@@ -163,21 +260,25 @@ def profile() -> str:
             realname = 'Bob Thomas'
         
         finally: 
-            # check if profile image was uploaded or use default
-            if exists(f'static/img/profiles/{unique_id}.png'):
-                profile_img = f'{unique_id}.png'
-            elif exists(f'static/img/profiles/{unique_id}.jpeg'):
-                profile_img = f'{unique_id}.jpeg'
-            else: profile_img = 'anonymous.png'
-
-            # load blogs for side bar
-            db = DB(DB_PATH)
-            blogs = db.select(TABLES.get('blog'), ('unique_id', 'title'), where=f'WHERE unique_id="{unique_id}"')
-            try: blogs = tuple(map(lambda b: (quote(f'{b[0]}_{b[1]}'), b[1]), blogs))
-            except TypeError: blogs = ()
-            db.close()
-
-        return render_template('profile.html', profile_img=profile_img, username=username, email=email, realname=realname, blogs=blogs)
+            # uploaded profile image or default
+            ext, img_version = img
+            profile_img = f'{unique_id}.{ext}' if ext else 'anonymous.png'
+            # smaller variants, the browser picks the smallest that fits
+            if ext and img_version is not None:
+                profile_srcset = ', '.join(f'/static/img/profiles/{unique_id}_{i}.webp {i}w' for i in IMG_SIZES)
+            else: profile_srcset = None
+
+            # load page of blogs for side bar
+            blogs, prev_page, next_page = profile_blogs(unique_id, request.args.get('after'), request.args.get('before'))
+            blogs = tuple(map(lambda b: (quote(f'{b[0]}_{b[1]}'), b[1]), blogs))
+
+        if request.args.get('view'):
+            # answer repeated views without rendering
+            etag = make_etag(unique_id, username, email, realname, profile_img, img_version, blogs, prev_page, next_page)
+            if not is_resource_modified(request.environ, etag):
+                return not_modified(etag)
+            return conditional(render_template('profile.html', profile_img=profile_img, profile_srcset=profile_srcset, username=username, email=email, realname=realname, blogs=blogs, view=request.args.get('view'), prev=prev_page, next=next_page), etag)
+        return render_template('profile.html', profile_img=profile_img, profile_srcset=profile_srcset, username=username, email=email, realname=realname, blogs=blogs, view=request.args.get('view'), prev=prev_page, next=next_page)
 
     elif request.method == 'POST': 
         # update profile
@@ -201,14 +302,14 @@ def profile() -> str:
             
             # obtain update data that requires a password
             if request.form.get('password') != '':
-                if bcrypt.check_password_hash(password_hash, request.form.get('password')):
+                if hasher.check(password_hash, request.form.get('password')):
                     if request.form.get('realname') != '':
                         name = request.form.get('realname').split()
                         data.update({'firstname': name[0], 'lastname': ' '.join(name[1:len(name)]) if len(name) > 1 else None})
                     if request.form.get('email') != '':
                         data.update({'email': request.form.get('email')})
                     if request.form.get('newpassword') != '':
-                        data.update({'password': bcrypt.generate_password_hash(request.form.get('newpassword')).decode()})
+                        data.update({'password': hasher.hash(request.form.get('newpassword'))})
                 else: 
                     return error('Wrong Password', 'The given password didn\'t match.', '/profile')
 
@@ -268,9 +369,15 @@ def explore() -> str:
                 except TypeError: 
                     db.close()
                     username = 'anonymous'
+                # answer repeated reads without rendering
+                try: st = storage.stat(blog_id)
+                except OSError: raise InvalidBlogIDError
+                etag = make_etag(blog_id, st.st_mtime_ns, st.st_size, username, authorized)
+                if not is_resource_modified(request.environ, etag): # no Last-Modified, the mtime doesn't cover author and login state
+                    return not_modified(etag)
                 # return blog
                 log.debug(f'requested blog: {blog_id}')
-                return render_template('read.html', blog=load_blog_html(blog_id), unique_id=uid, username=username, authorized=authorized, blog_id=blog_id)
+                return conditional(render_template('read.html', blog=load_blog_html(blog_id), unique_id=uid, username=username, authorized=authorized, blog_id=blog_id), etag)
             
             except InvalidBlogIDError:
                 return error('Blog not found', 'The requested blog wasn\'t found.', '/explore')
@@ -283,32 +390,22 @@ def explore() -> str:
             for i in request.args.get('search').split():
                 if i.startswith('#'): tags.append(i.removeprefix('#'))
                 else: title.append(i)
-            try:
-                db = DB(DB_PATH)
-                # build where statement
-                title_statement = f'title LIKE \"%{" ".join(title) if title else ""}%\"' if len(title) != 0 else ''
-                tags_statement = 'tags LIKE "%{}%" AND ' * len(tags)
-                where_statement = f'WHERE {title_statement}{" AND " if title and tags else ""}{tags_statement}'.format(*tags).removesuffix(' AND ')
-                # select matching blogs from db
-                blogs = db.select(TABLES['blog'], ('unique_id', 'title'), where=where_statement)
-                blogs = tuple(map(lambda b: (quote(f'{b[0]}_{b[1]}'), b[1]), blogs)) # fromat blog info for url
-                db.close()
-                # return results
-                log.debug(f'Search results: {len(blogs)}')
-                return render_template('explore.html', blogs=blogs)
-            
-            except TypeError:
-                db.close()
+            try: page = max(int(request.args.get('page', 0)), 0)
+            except ValueError: page = 0
+            # select page of matching blogs ranked from search index
+            blogs, prev_page, next_page = search_blogs(title, tags, page, request.args.get('after'), request.args.get('before'))
+            if not blogs and prev_page is None:
                 return error('No Blog Found', 'No blog was found.', '/explore')
+            blogs = tuple(map(lambda b: (quote(f'{b[0]}_{b[1]}'), b[1]), blogs)) # fromat blog info for url
+            # return results
+            log.debug(f'Search results: {len(blogs)}')
+            return render_template('explore.html', blogs=blogs, search=request.args.get('search'), prev=prev_page, next=next_page)
         
         else:
             # get random blogs
-            db = DB(DB_PATH)
-            db_res = db.select(TABLES['blog'], ('unique_id', 'title'))
-            if db_res is not None: blogs = choices(db_res, k=5)
-            else: blogs = (('noblock', 'noblock'),)
+            blogs = random_blogs()
+            if not blogs: blogs = (('noblock', 'noblock'),)
             blogs = tuple(map(lambda b: (quote(f'{b[0]}_{b[1]}'), b[1]), blogs)) # fromat blog info for url
-            db.close()
             return render_template('explore.html', blogs=blogs)
     else: 
         return error('Invalid Method', 'The used http message isn\'t allowed.', '/explore')
@@ -397,12 +494,46 @@ def blog(route) -> str:
         return error('Invalid Method', 'The used http message isn\'t allowed.', '/blog')
 
 
+_navbar = dict() # logged in -> rendered navbar
+
+
+@app.context_processor
+def inline_navbar() -> dict:
+    """Navbar rendered into the pages instead of an iframe, cached per login state."""
+    session = True if request.cookies.get('session') else False
+    if session not in _navbar or app.debug: # templates are reloaded in debug mode
+        _navbar[session] = Markup(app.jinja_env.get_template('bar.html').render(session=session)) # without context processors
+    return {'navbar': _navbar[session]}
+
+
 @app.route('/navbar', methods=('GET',))
 def navbar() -> str:
-    """Loads the navigation bar."""
+    """Loads the navigation bar as own document, the pages render it inline."""
     return render_template('navbar.html', session=True if request.cookies.get('session') else False)
 
 
+@app.route('/tags', methods=('GET',))
+def tags() -> tuple:
+    """Most used tags with their number of blogs, for tag clouds and search facets."""
+    try: limit = min(max(int(request.args.get('limit', 50)), 1), 200)
+    except ValueError: limit = 50
+    return jsonify([{'tag': tag, 'count': count} for tag, count in tag_counts(limit)]), 200, {'Cache-Control': 'public, max-age=30'}
+
+
+@app.route('/metrics', methods=('GET',))
+def metrics_endpoint() -> tuple:
+    """Metrics of all workers in the prometheus text format."""
+    if request.remote_addr not in METRICS_ALLOW: abort(404)
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+@app.route('/metrics/sql', methods=('GET',))
+def sql_report() -> tuple:
+    """Statement counts and timings of all workers, slowest first."""
+    if request.remote_addr not in METRICS_ALLOW: abort(404)
+    return QueryStats.report(metrics.collect('sql')), 200, {'Content-Type': 'text/plain; charset=utf-8'}
+
+
 def success(success:str, message:str, _continue:str) -> str:
     """
     Custom "Operation Succeed" page with message.
@@ -423,6 +554,36 @@ def error(error:str, message:str, back:str) -> str:
     return render_template('error.html', error=error, message=message, back=back)
 
 
+def make_etag(*state) -> str:
+    """Strong etag of the state a page is rendered from, the login state changes the navbar."""
+    return sha256(repr((TEMPLATES_VERSION, True if request.cookies.get('session') else False) + state).encode()).hexdigest()[:32]
+
+
+def conditional(page:str, etag:str):
+    """
+    Response with validators, browsers have to revalidate it on every visit.
+    The page depends on the session, so it's private and varies by cookie.
+    """
+    response = make_response(page)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response
+
+
+def not_modified(etag:str):
+    """Empty 304 response, the browser shows its cached page."""
+    response = conditional('', etag)
+    response.status_code = 304
+    return response
+
+
+@app.errorhandler(HashQueueFullError)
+def server_busy(e):
+    """Too many passwords are hashed at the moment."""
+    return error('Server Busy', 'Too many requests at the moment, please try again later.', '/'), 503
+
+
 @app.errorhandler(404)
 def page_not_found(e):
     """Custom error 404 page."""
@@ -0,0 +1,206 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from os import getpid
+from hashlib import blake2b
+import mmap
+import struct
+
+try: import fcntl
+except ImportError: # windows, the generation isn't shared between processes then
+    fcntl = None
+
+COUNTER = struct.Struct('<Q')
+
+
+class TTLCache:
+    def __init__(self, max_size:int = 1024, ttl:float = 60) -> None:
+        """In-process cache with a lifetime per entry and LRU eviction when full."""
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict() # key -> (deadline, value)
+        self._lock = Lock()
+
+
+    def get(self, key, default=None):
+        """Return cached value or default if missing or expired."""
+        with self._lock:
+            try: deadline, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if deadline < monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+
+    def set(self, key, value, ttl:float|None = None) -> None:
+        """Cache value, the least recently used entry is evicted if the cache is full."""
+        if self.max_size <= 0: return
+        with self._lock:
+            self._data[key] = (monotonic() + (self.ttl if ttl is None else min(ttl, self.ttl)), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+
+    def invalidate(self, key) -> None:
+        """Remove entry from cache."""
+        with self._lock:
+            self._data.pop(key, None)
+
+
+    def invalidate_where(self, check) -> None:
+        """Remove all entries where check(value) is True."""
+        with self._lock:
+            for key in tuple(key for key, (_, value) in self._data.items() if check(value)):
+                del self._data[key]
+
+
+    def clear(self) -> None:
+        """Remove all entries."""
+        with self._lock:
+            self._data.clear()
+
+
+    def stats(self) -> dict:
+        """Return hit/miss counters and size of the cache."""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits_total': self.hits,
+                'misses_total': self.misses,
+                'ratio': self.hits / total if total else 0.0,
+                'size': len(self._data),
+                'max_size': self.max_size,
+            }
+
+
+class SizedCache:
+    def __init__(self, max_bytes:int = 32 * 1024 * 1024) -> None:
+        """In-process LRU cache bounded by the summed size of its values."""
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict() # key -> (version, size, value)
+        self._lock = Lock()
+
+
+    def get(self, key, version=None, default=None):
+        """Return cached value or default if missing or cached for another version."""
+        with self._lock:
+            try: cached_version, size, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if cached_version != version: # outdated
+                del self._data[key]
+                self.bytes -= size
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+
+    def set(self, key, value, size:int, version=None) -> None:
+        """Cache value, least recently used entries are evicted until it fits."""
+        if size > self.max_bytes: return
+        with self._lock:
+            try: self.bytes -= self._data.pop(key)[1]
+            except KeyError: pass
+            self._data[key] = (version, size, value)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self.bytes -= self._data.popitem(last=False)[1][1]
+
+
+    def invalidate(self, key) -> None:
+        """Remove entry from cache."""
+        with self._lock:
+            try: self.bytes -= self._data.pop(key)[1]
+            except KeyError: pass
+
+
+    def clear(self) -> None:
+        """Remove all entries."""
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+
+    def stats(self) -> dict:
+        """Return hit/miss counters and memory use of the cache."""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits_total': self.hits,
+                'misses_total': self.misses,
+                'ratio': self.hits / total if total else 0.0,
+                'size': len(self._data),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+
+class Generation:
+    def __init__(self, path:str|None = None, slots:int = 16384) -> None:
+        """
+        Generation counters per key in the memory mapped file path, shared between worker processes.
+        Cached entries are tagged with the generation of their key when they were read, bumping it outdates them in every process.
+        Keys are hashed into slots, keys sharing a slot only outdate each other's entries.
+        """
+        self.path = path
+        self.slots = slots
+        self._lock = Lock()
+        self._pid = None
+
+
+    def _open(self) -> None:
+        """Map the counters, again in forked processes since the file lock belongs to the open file."""
+        size = self.slots * COUNTER.size
+        if self.path is None or fcntl is None:
+            self._file, self._map = None, mmap.mmap(-1, size)
+        else:
+            self._file = open(self.path, 'a+b')
+            if self._file.seek(0, 2) < size: self._file.truncate(size)
+            self._map = mmap.mmap(self._file.fileno(), size)
+        self._pid = getpid()
+
+
+    def _mapped(self) -> mmap.mmap:
+        """Counters of the current process."""
+        if self._pid != getpid(): # the lock may have been held by another thread at fork
+            self._lock = Lock()
+            self._open()
+        return self._map
+
+
+    def _offset(self, key:str) -> int:
+        """Position of the counter of key."""
+        return int.from_bytes(blake2b(key.encode(), digest_size=8).digest(), 'little') % self.slots * COUNTER.size
+
+
+    def value(self, key:str) -> int:
+        """Return current generation of key."""
+        return COUNTER.unpack_from(self._mapped(), self._offset(key))[0]
+
+
+    def bump(self, key:str) -> int:
+        """Start a new generation of key and return it."""
+        counters, offset = self._mapped(), self._offset(key)
+        with self._lock:
+            if self._file is not None: fcntl.flock(self._file, fcntl.LOCK_EX)
+            try:
+                generation = COUNTER.unpack_from(counters, offset)[0] + 1
+                COUNTER.pack_into(counters, offset, generation)
+            finally:
+                if self._file is not None: fcntl.flock(self._file, fcntl.LOCK_UN)
+        return generation
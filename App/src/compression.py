@@ -0,0 +1,113 @@
+from src.logger import Logger
+from src.exception import JSONDecodeError
+from os import walk
+from os.path import exists, getmtime, join
+import gzip
+
+log = Logger('CompressLog')
+
+try:
+    with open('./config.json', 'r') as f:
+        CONFIG:dict = __import__('json').load(f)
+except JSONDecodeError:
+    log.critical('failed to load config file')
+    exit(1)
+
+# update loglist
+log.remove_loglist(*CONFIG.get('log')['remove'])
+
+try: import brotli
+except ImportError: # optional, only gzip is offered without it
+    brotli = None
+
+EXTENSIONS = {'br': '.br', 'gzip': '.gz'}
+COMPRESSIBLE = ('text/', 'application/json', 'application/javascript', 'image/svg+xml')
+STATIC_TYPES = ('.css', '.js', '.html', '.svg', '.txt', '.json') # no .md, legacy blogs in static/blogs aren't published
+
+
+class Compressor:
+    def __init__(self, min_size:int = 1024, gzip_level:int = 6, brotli_quality:int = 5) -> None:
+        """
+        Negotiate and apply brotli or gzip for responses of at least min_size bytes.
+        Static files are compressed ahead of time with the highest levels.
+        """
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.encodings = ('br', 'gzip') if brotli is not None else ('gzip',) # preferred first
+
+
+    def encoding(self, accept) -> str|None:
+        """Return best encoding the client accepts, accept is the parsed Accept-Encoding header."""
+        best = accept.best_match(self.encodings)
+        return best if best and accept[best] > 0 else None
+
+
+    def compress(self, data:bytes, encoding:str, best:bool = False) -> bytes:
+        """Compress data, best for the highest level."""
+        if encoding == 'br': return brotli.compress(data, quality=11 if best else self.brotli_quality)
+        return gzip.compress(data, compresslevel=9 if best else self.gzip_level, mtime=0)
+
+
+    def compress_response(self, response, accept):
+        """Compress body of response in place if it's worth it and the client accepts it."""
+        if (
+            response.direct_passthrough # files are streamed, static ones are precompressed
+            or response.status_code not in (200, 304)
+            or 'Content-Encoding' in response.headers
+            or not response.mimetype.startswith(COMPRESSIBLE)
+        ): return response
+        response.vary.add('Accept-Encoding')
+        encoding = self.encoding(accept)
+        if encoding is None: return response
+        if response.status_code == 304: # validators have to match the ones of the compressed page
+            etag, weak = response.get_etag()
+            if etag and not weak: response.set_etag(etag, weak=True)
+            return response
+        data = response.get_data()
+        if len(data) < self.min_size: return response
+        response.set_data(self.compress(data, encoding))
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak: response.set_etag(etag, weak=True) # same page, other bytes
+        return response
+
+
+    def static_variant(self, path:str, accept) -> tuple|None:
+        """Return path and encoding of a precompressed file next to path if there is an up to date one the client accepts."""
+        if not path.endswith(STATIC_TYPES): return None
+        for encoding in self.encodings:
+            if accept[encoding] <= 0: continue
+            try:
+                if getmtime(path + EXTENSIONS[encoding]) >= getmtime(path): return path + EXTENSIONS[encoding], encoding
+            except OSError: continue # not precompressed, e.g. brotli wasn't installed at setup
+        return None
+
+
+    def precompress(self, directory:str) -> int:
+        """Write compressed variants of the text files in directory. Returns number of written files."""
+        written = 0
+        for root, _, files in walk(directory):
+            for file in files:
+                if not file.endswith(STATIC_TYPES): continue
+                path = join(root, file)
+                with open(path, 'rb') as f:
+                    data = f.read()
+                for encoding in self.encodings:
+                    target = path + EXTENSIONS[encoding]
+                    if exists(target) and getmtime(target) >= getmtime(path): continue
+                    compressed = self.compress(data, encoding, best=True)
+                    if len(compressed) >= len(data): continue # not worth it
+                    with open(target, 'wb') as f:
+                        f.write(compressed)
+                    written += 1
+                    log.debug(f'precompressed: {target}')
+        log.info(f'precompressed {written} static files')
+        return written
+
+
+compressor = Compressor(
+    CONFIG.get('compression', {}).get('min_size', 1024),
+    CONFIG.get('compression', {}).get('gzip_level', 6),
+    CONFIG.get('compression', {}).get('brotli_quality', 5)
+)
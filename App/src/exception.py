@@ -24,3 +24,7 @@ class InvalidBlogIDError(Exception):
 class UserNotFoundError(Exception):
     def __init__(self) -> None:
         super().__init__('user not found')
+
+class HashQueueFullError(Exception):
+    def __init__(self) -> None:
+        super().__init__('too many password hashes queued')
@@ -1,11 +1,22 @@
 from src.logger import Logger
-from src.sql import DB
+from src.sql import DB, pool
 from src.exception import InvalidBlogIDError, JSONDecodeError
+from src.cache import SizedCache, TTLCache
+from src.session import refresh_user_session
+from src.storage import storage
 from werkzeug.datastructures import FileStorage
 from PIL import Image
 from os.path import exists
-from os import remove
+from os import remove, listdir, stat
+from functools import partial
+from time import time_ns
+from sys import getsizeof
 from markdown import markdown
+from random import randint
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, Future
+from multiprocessing import get_context
+from threading import Lock
 
 log = Logger('FunctionsLog')
 
@@ -21,34 +32,89 @@ log.remove_loglist(*CONFIG.get('log')['remove'])
 
 DB_PATH = CONFIG.get('db')['path']
 TABLES = CONFIG.get('db')['tables']
+SEARCH_TABLE = TABLES.get('search', 'blogs_fts')
+TAG_TABLE = TABLES.get('tag', 'blog_tags')
+TAG_COUNT_TABLE = TABLES.get('tag_count', 'tag_counts')
+SEARCH_PAGE_SIZE = CONFIG.get('vars').get('search_page_size', 20)
+PROFILE_PAGE_SIZE = CONFIG.get('vars').get('profile_page_size', 20)
+SAMPLE_SIZE = CONFIG.get('vars').get('explore_sample_size', 5)
+IMG_SIZES = tuple(sorted(CONFIG.get('img', {}).get('sizes', (96, 192, 384))))
+IMG_QUALITY = CONFIG.get('img', {}).get('quality', 80)
+IMG_PROCESSES = CONFIG.get('img', {}).get('processes', 2)
+
+# rendered blogs, validated by mtime and size of the blog file
+html_cache = SizedCache(CONFIG.get('cache', {}).get('blog_html', {}).get('max_bytes', 32 * 1024 * 1024))
+
+# most used tags per limit, the counts are kept up to date by the db
+tag_cache = TTLCache(
+    CONFIG.get('cache', {}).get('tags', {}).get('max_size', 16),
+    CONFIG.get('cache', {}).get('tags', {}).get('ttl', 30)
+)
+
+
+_img_pool = None
+_img_pool_lock = Lock()
+
+
+def _image_pool() -> ProcessPoolExecutor:
+    """Return process pool for image processing, started on first use."""
+    global _img_pool
+    with _img_pool_lock:
+        if _img_pool is None:
+            _img_pool = ProcessPoolExecutor(IMG_PROCESSES, get_context('spawn')) # forking a threaded server isn't safe
+        return _img_pool
 
 
 def save_profile_img(uid:str, img:FileStorage) -> None:
-    """Save and crop profile image."""
+    """
+    Check type of profile image and process it in the image process pool.
+    Raises TypeError if the file type isn't supported.
+    """
+    try: ext = Image.open(img.stream).format.lower() # only reads the header
+    except Exception: raise TypeError('file type not supported')
+    if ext not in ('png', 'jpeg'): 
+        raise TypeError('file type not supported')
+    img.stream.seek(0)
+    _image_pool().submit(process_profile_img, uid, img.stream.read(), ext).add_done_callback(partial(_index_profile_img, uid, ext))
+    log.debug(f'queued profile image for: {uid}')
+
+
+def _index_profile_img(uid:str, ext:str, future:Future) -> None:
+    """Record processed profile image in the users table or log errors of image processing."""
+    if future.exception() is not None:
+        log.error(f'failed to process profile image: {future.exception().__str__()}')
+        return
+    try:
+        db = DB(DB_PATH)
+        db.update(TABLES['user-data'], {'profile_img': ext, 'profile_img_version': time_ns()}, 'WHERE unique_id = ?', (uid,))
+        db.close()
+        refresh_user_session(uid) # the session row caches the image version
+    except Exception as e:
+        log.error(f'failed to index profile image of: {uid}: {e.__str__()}')
+    finally: pool.release() # runs in a thread of the pool manager
+
+
+def process_profile_img(uid:str, data:bytes, ext:str) -> None:
+    """Crop profile image and save it with smaller webp variants."""
     # obtain and process image
-    input_img = Image.open(img.stream)
-    ext = input_img.format.lower()
-    dif = abs(input_img.width - input_img.height)
+    input_img = Image.open(BytesIO(data))
+    side = min(input_img.width, input_img.height)
+    left, top = (input_img.width - side) // 2, (input_img.height - side) // 2
     
     # crop image
-    if input_img.width > input_img.height:
-        out_img = input_img.crop((dif / 2, 0, input_img.width - dif / 2, input_img.height))
-    elif input_img.height > input_img.width:
-        out_img = input_img.crop((0, dif / 2, input_img.width, input_img.height - dif / 2))
-    else: 
-        out_img = input_img.crop((dif / 2, 0, input_img.width - dif / 2, input_img.height))
-        out_img = input_img.crop((0, dif / 2, input_img.width, input_img.height - dif / 2))
-
+    out_img = input_img.crop((left, top, left + side, top + side))
     log.debug(f'cropped image to: {out_img.width=}:{out_img.height=}')
+
+    # save variants
+    variant = out_img.convert('RGBA' if out_img.mode in ('RGBA', 'LA', 'P') else 'RGB')
+    for size in IMG_SIZES:
+        variant.resize((size, size), Image.LANCZOS).save(f'static/img/profiles/{uid}_{size}.webp', format='webp', quality=IMG_QUALITY)
     
     # save or replace image
-    if ext in ('png', 'jpeg'):
-        if exists(f'static/img/profiles/{uid}.png'): remove(f'static/img/profiles/{uid}.png')
-        if exists(f'static/img/profiles/{uid}.jpeg'): remove(f'static/img/profiles/{uid}.jpeg')
-        out_img.save(f'static/img/profiles/{uid}.{ext}', format=ext)
-        log.debug(f'save profile image for: {uid}')
-    else: 
-        raise TypeError('file type not supported')
+    out_img.save(f'static/img/profiles/{uid}.{ext}', format=ext)
+    old = f'static/img/profiles/{uid}.{"jpeg" if ext == "png" else "png"}'
+    if exists(old): remove(old)
+    log.debug(f'save profile image for: {uid}')
 
 
 def save_blog_post(uid:str, title:str, blog:str, overwrite=False) -> bool:
@@ -56,43 +122,46 @@ def save_blog_post(uid:str, title:str, blog:str, overwrite=False) -> bool:
     Save blog in file. 
     Returns True if successful and False if blog already exists.
     """
-    path = f'static/blogs/{uid}_{title}.md'
-    if not exists(path) or overwrite:
-        with open(path, 'w') as f:
-            f.write(blog)
-        log.debug(f'saved blog in: {path}')
+    blog_id = f'{uid}_{title}'
+    if overwrite or not storage.exists(blog_id):
+        storage.write(blog_id, blog)
+        html_cache.invalidate(blog_id)
+        log.debug(f'saved blog: {blog_id}')
+        index_blog(uid, title, body=blog)
         return True
     else: return False
 
 
 def save_blog_entry(uid:str, username:str, title:str, tags:str) -> None:
-    """Save blog data to db."""
+    """Save blog data and its tags to db."""
+    def insert(cursor) -> None:
+        cursor.execute(f'INSERT INTO {TABLES["blog"]} (unique_id, username, title, tags) VALUES (?, ?, ?, ?);', (uid, username, title, tags))
+        cursor.executemany(f'INSERT OR IGNORE INTO {TAG_TABLE} (tag, blog_id) VALUES (?, ?);', [(tag, cursor.lastrowid) for tag in parse_tags(tags)])
     db = DB(DB_PATH)
-    db.insert(TABLES['blog'], {
-        'unique_id': uid,
-        'username': username,
-        'title': title,
-        'tags': tags,
-    })
+    db.transaction(insert)
     db.close()
+    index_blog(uid, title, tags=tags)
     log.debug(f'saved blog in db: {username}: {title}')
 
 
 def load_blog_html(blog_id:str) -> str:
     """Load blog in html format, raise InvalidBlogIDError if blog doesn't exist."""
-    if exists(f'static/blogs/{blog_id}.md'):
-        with open(f'static/blogs/{blog_id}.md', 'r') as f:
-            return markdown(f.read(), output_format='html')
-    else: raise InvalidBlogIDError
+    try: 
+        st = storage.stat(blog_id)
+        version = (st.st_mtime_ns, st.st_size)
+    except OSError: raise InvalidBlogIDError
+    html = html_cache.get(blog_id, version)
+    if html is None:
+        try: html = markdown(storage.read(blog_id), output_format='html')
+        except OSError: raise InvalidBlogIDError
+        html_cache.set(blog_id, html, getsizeof(html), version)
+    return html
 
 
 def load_blog_plain(blog_id:str) -> str:
     """Load blog in plain text, raise InvalidBlogIDError if blog doesn't exist."""
-    if exists(f'static/blogs/{blog_id}.md'):
-        with open(f'static/blogs/{blog_id}.md', 'r') as f:
-            text = f.read().replace('\n\n\n', '\n')
-        return text
-    else: raise InvalidBlogIDError
+    try: return storage.read(blog_id).replace('\n\n\n', '\n')
+    except OSError: raise InvalidBlogIDError
 
 
 def delete_blog_post(blog_id:str) -> bool:
@@ -102,8 +171,8 @@ def delete_blog_post(blog_id:str) -> bool:
     """
     try: 
         log.debug(f'delete blog: {blog_id}')
-        remove(f'static/blogs/{blog_id}.md')
-        return True
+        html_cache.invalidate(blog_id)
+        return storage.delete(blog_id)
     except: 
         return False
 
@@ -115,10 +184,173 @@ def delete_blog_entry(blog_id:str) -> bool:
     """
     try:
         blog = blog_id.split('_', 1)
+        def delete(cursor) -> None:
+            cursor.execute(f'DELETE FROM {TAG_TABLE} WHERE blog_id IN (SELECT id FROM {TABLES["blog"]} WHERE unique_id = ? AND title = ?);', (blog[0], blog[1]))
+            cursor.execute(f'DELETE FROM {TABLES["blog"]} WHERE unique_id = ? AND title = ?;', (blog[0], blog[1]))
+            cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE unique_id = ? AND title = ?;', (blog[0], blog[1]))
         db = DB(DB_PATH)
-        db.delete(TABLES['blog'], f'WHERE unique_id="{blog[0]}" AND title="{blog[1]}"')
+        db.transaction(delete) # blog, tags and search index at once
         db.close()
         return True
     except (TypeError, IndexError): 
         db.close()
         return False
+
+
+def index_blog(uid:str, title:str, tags:str|None = None, body:str|None = None) -> None:
+    """Add blog to the search index or update tags/body of the indexed blog."""
+    db = DB(DB_PATH)
+    try:
+        old_tags, old_body = db.select(SEARCH_TABLE, ('tags', 'body'), 'WHERE unique_id = ? AND title = ?', (uid, title))[0]
+        db.delete(SEARCH_TABLE, 'WHERE unique_id = ? AND title = ?', (uid, title))
+    except TypeError: old_tags, old_body = None, None
+    db.insert(SEARCH_TABLE, {
+        'unique_id': uid,
+        'title': title,
+        'tags': tags if tags is not None else old_tags,
+        'body': body if body is not None else old_body,
+    })
+    db.close()
+
+
+def parse_tags(tags:str|None) -> tuple:
+    """Split comma or space separated tags into lowercase tags without duplicates."""
+    return tuple(dict.fromkeys(t.lstrip('#').lower() for t in (tags or '').replace(',', ' ').split() if t.lstrip('#')))
+
+
+def save_tags(db:DB, blog_id:int, tags:str|None) -> None:
+    """Add tags of blog to the tag table without committing, the tag counts are kept by triggers."""
+    db.insert_many(TAG_TABLE, ('tag', 'blog_id'), [(tag, blog_id) for tag in parse_tags(tags)], ignore=True, commit=False)
+
+
+def fill_tag_index(db:DB) -> int:
+    """Replace content of the tag table with the tags of the blogs without committing. Returns number of tagged blogs."""
+    db.execute(f'DELETE FROM {TAG_TABLE};')
+    blogs = db.select(TABLES['blog'], ('id', 'tags'), 'WHERE tags IS NOT NULL') or ()
+    for blog_id, tags in blogs:
+        save_tags(db, blog_id, tags)
+    return len(blogs)
+
+
+def tag_counts(limit:int = 50) -> tuple:
+    """Return (tag, number of blogs) of the most used tags."""
+    counts = tag_cache.get(limit)
+    if counts is None:
+        db = DB(DB_PATH)
+        counts = db.select(TAG_COUNT_TABLE, ('tag', 'count'), 'WHERE count > 0 ORDER BY count DESC, tag LIMIT ?', (limit,)) or ()
+        db.close()
+        tag_cache.set(limit, counts)
+    return counts
+
+
+def _keyset_page(table:str, columns:tuple, where:str, params:tuple, order:tuple, types:tuple, after:str|None, before:str|None, size:int) -> tuple:
+    """
+    Page of rows ordered by the unique key of the order columns, following the row of cursor after or preceding the one of before.
+    A cursor is the key of a row joined by ":", unlike offsets the rows of previous pages aren't read again.
+    Returns rows of the page and cursors of the previous and next page (None if there is no such page).
+    """
+    backward = before is not None
+    cursor = before if backward else after
+    try: key = tuple(t(v) for t, v in zip(types, cursor.split(':'), strict=True)) if cursor else ()
+    except ValueError: key, backward = (), False # invalid cursor, start at the first page
+    if key: where += f' AND ({", ".join(order)}) {"<" if backward else ">"} ({", ".join("?" * len(key))})'
+    db = DB(DB_PATH)
+    rows = db.select(table, tuple(columns) + tuple(order), f'{where} ORDER BY {", ".join(f"{i} DESC" if backward else i for i in order)} LIMIT ?', params + key + (size + 1,)) or ()
+    db.close()
+    more = len(rows) > size
+    rows = rows[:size][::-1] if backward else rows[:size]
+    if not rows: return (), None, None
+    first, last = (':'.join(map(repr, row[len(columns):])) for row in (rows[0], rows[-1]))
+    rows = tuple(row[:len(columns)] for row in rows)
+    if backward: return rows, first if more else None, last
+    return rows, first if key else None, last if more else None
+
+
+def _offset_page(table:str, columns:tuple, where:str, params:tuple, order:tuple, page:int, size:int) -> tuple:
+    """Page number page of rows ordered by the order columns. Returns rows of the page and if there are more pages."""
+    db = DB(DB_PATH)
+    rows = db.select(table, columns, f'{where} ORDER BY {", ".join(order)} LIMIT ? OFFSET ?', params + (size + 1, page * size)) or ()
+    db.close()
+    return rows[:size], len(rows) > size
+
+
+def search_blogs(terms:list, tags:list, page:int = 0, after:str|None = None, before:str|None = None) -> tuple:
+    """
+    Search blogs ranked by relevance, terms match title and body, tags have to match exactly.
+    Ranked results are paged by offset, the rank is computed per query and changes with the other blogs, so it can't serve as cursor
+    and every page scores all matches anyway. Blogs found by tags only are ordered by age and paged by cursor like profile_blogs.
+    Returns (unique_id, title) of blogs on the page and the query parameters of the previous and next page (None if there is no such page).
+    """
+    quote_term = lambda t: '"{}"'.format(t.replace('"', '""'))
+    query = ' AND '.join(f'{{title body}} : {quote_term(t)}*' for t in terms if t)
+    tags = parse_tags(' '.join(tags))
+    # blogs having all tags, exact matches on the tag table
+    tagged = ' INTERSECT '.join(f'SELECT blog_id FROM {TAG_TABLE} WHERE tag = ?' for _ in tags)
+    if tags and not query:
+        blogs, prev_page, next_page = _keyset_page(TABLES['blog'], ('unique_id', 'title'), f'WHERE id IN ({tagged})', tags, ('id',), (int,), after, before, SEARCH_PAGE_SIZE)
+        return blogs, {'before': prev_page} if prev_page else None, {'after': next_page} if next_page else None
+    if query and tags:
+        blogs, more = _offset_page(SEARCH_TABLE, ('unique_id', 'title'), 
+                            f'WHERE {SEARCH_TABLE} MATCH ? AND (unique_id, title) IN (SELECT unique_id, title FROM {TABLES["blog"]} WHERE id IN ({tagged}))', 
+                            (query,) + tags, ('rank', 'rowid'), page, SEARCH_PAGE_SIZE)
+    elif query:
+        blogs, more = _offset_page(SEARCH_TABLE, ('unique_id', 'title'), f'WHERE {SEARCH_TABLE} MATCH ?', (query,), ('rank', 'rowid'), page, SEARCH_PAGE_SIZE)
+    else: return (), None, None
+    return blogs, {'page': page - 1} if page > 0 else None, {'page': page + 1} if more else None
+
+
+def profile_blogs(uid:str, after:str|None = None, before:str|None = None) -> tuple:
+    """Returns (unique_id, title) of blogs of user on the page and cursors of the previous and next page."""
+    return _keyset_page(TABLES['blog'], ('unique_id', 'title'), 'WHERE unique_id = ?', (uid,), ('id',), (int,), after, before, PROFILE_PAGE_SIZE)
+
+
+def rebuild_search_index() -> int:
+    """Rebuild search index from the blog files. Returns number of indexed blogs."""
+    db = DB(DB_PATH)
+    count = fill_search_index(db)
+    db.close()
+    log.info(f'rebuilt search index: {count} blogs')
+    return count
+
+
+def fill_profile_index(db:DB) -> int:
+    """Record profile images of the profiles directory in the users table without committing. Returns number of indexed images."""
+    count = 0
+    for file in listdir('static/img/profiles') if exists('static/img/profiles') else ():
+        uid, _, ext = file.partition('.')
+        if ext not in ('png', 'jpeg') or uid == 'anonymous': continue
+        # images without webp variants are from older versions and have no version
+        version = stat(f'static/img/profiles/{file}').st_mtime_ns if exists(f'static/img/profiles/{uid}_{IMG_SIZES[0]}.webp') else None
+        db.execute(f'UPDATE {TABLES["user-data"]} SET profile_img = ?, profile_img_version = ? WHERE unique_id = ?;', (ext, version, uid))
+        count += 1
+    return count
+
+
+def fill_search_index(db:DB) -> int:
+    """Replace content of the search index with the blogs in the db and their files without committing. Returns number of indexed blogs."""
+    db.execute(f'DELETE FROM {SEARCH_TABLE};')
+    count = 0
+    for uid, title, tags in db.select(TABLES['blog'], ('unique_id', 'title', 'tags')) or ():
+        try: body = storage.read(f'{uid}_{title}')
+        except OSError: body = None
+        db.execute(f'INSERT INTO {SEARCH_TABLE} (unique_id, title, tags, body) VALUES (?, ?, ?, ?);', (uid, title, tags, body))
+        count += 1
+    return count
+
+
+def random_blogs(k:int = SAMPLE_SIZE) -> tuple:
+    """
+    Return up to k distinct random blogs as (unique_id, title).
+    Seeks random ids on the primary key, so only the returned rows are read.
+    """
+    db = DB(DB_PATH)
+    try:
+        max_id = db.execute(f'SELECT max(id) FROM {TABLES["blog"]};')[0][0]
+        if max_id is None: return ()
+        blogs = dict()
+        for _ in range(k * 3): # ids of deleted blogs lead to duplicates, so try a few more times
+            if len(blogs) >= k: break
+            blog = db.select(TABLES['blog'], ('id', 'unique_id', 'title'), 'WHERE id >= ? ORDER BY id LIMIT 1', (randint(1, max_id), ))
+            if blog is not None: blogs[blog[0][0]] = blog[0][1:]
+        return tuple(blogs.values())
+    finally: db.close()
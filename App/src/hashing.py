@@ -0,0 +1,86 @@
+from src.logger import Logger
+from src.exception import HashQueueFullError, JSONDecodeError
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+from time import perf_counter
+import bcrypt
+
+log = Logger('HashLog')
+
+try:
+    with open('./config.json', 'r') as f:
+        CONFIG:dict = __import__('json').load(f)
+except JSONDecodeError:
+    log.critical('failed to load config file')
+    exit(1)
+
+# update loglist
+log.remove_loglist(*CONFIG.get('log')['remove'])
+
+
+class Hasher:
+    def __init__(self, rounds:int = 12, workers:int = 2, max_queue:int = 32) -> None:
+        """
+        Run bcrypt on a bounded thread pool, bcrypt releases the GIL while hashing.
+        Raises HashQueueFullError instead of queueing more than max_queue hashes.
+        """
+        self.rounds = rounds
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='bcrypt')
+        self._slots = BoundedSemaphore(workers + max_queue)
+        self._lock = Lock()
+        self._stats = {'hashes_total': 0, 'checks_total': 0, 'rejected_total': 0, 'seconds_total': 0.0, 'max_seconds': 0.0}
+
+
+    def _run(self, kind:str, func, *args):
+        """Run func in the pool and wait for the result."""
+        if not self._slots.acquire(blocking=False):
+            with self._lock: self._stats['rejected_total'] += 1
+            log.warning('password hash queue is full')
+            raise HashQueueFullError
+        try:
+            return self._executor.submit(self._timed, kind, func, *args).result()
+        finally: self._slots.release()
+
+
+    def _timed(self, kind:str, func, *args):
+        """Run func and record time spent."""
+        start = perf_counter()
+        try: return func(*args)
+        finally:
+            took = perf_counter() - start
+            with self._lock:
+                self._stats[kind] += 1
+                self._stats['seconds_total'] += took
+                self._stats['max_seconds'] = max(self._stats['max_seconds'], took)
+
+
+    def hash(self, password:str) -> str:
+        """Return bcrypt hash of password with the configured cost."""
+        return self._run('hashes_total', lambda: bcrypt.hashpw(password.encode(), bcrypt.gensalt(self.rounds)).decode())
+
+
+    def check(self, password_hash:str, password:str) -> bool:
+        """Return True if password matches the hash."""
+        return self._run('checks_total', lambda: bcrypt.checkpw(password.encode(), password_hash.encode()))
+
+
+    def outdated(self, password_hash:str) -> bool:
+        """Return True if the hash was created with a lower cost than configured."""
+        try: return int(password_hash.split('$')[2]) < self.rounds
+        except (IndexError, ValueError): return False
+
+
+    def stats(self) -> dict:
+        """Return counters and time spent hashing."""
+        with self._lock:
+            stats = dict(self._stats)
+        done = stats['hashes_total'] + stats['checks_total']
+        stats['avg_seconds'] = stats['seconds_total'] / done if done else 0.0
+        return stats
+
+
+hasher = Hasher(
+    CONFIG.get('bcrypt', {}).get('rounds', 12),
+    CONFIG.get('bcrypt', {}).get('workers', 2),
+    CONFIG.get('bcrypt', {}).get('max_queue', 32)
+)
@@ -0,0 +1,162 @@
+from src.logger import Logger
+from src.sql import DB
+from src.exception import JSONDecodeError
+from src.storage import storage
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from csv import DictReader
+from hashlib import sha256
+from uuid import uuid4
+from os import listdir
+from os.path import exists
+from time import perf_counter
+import bcrypt
+
+log = Logger('ImportLog')
+
+try:
+    with open('./config.json', 'r') as f:
+        CONFIG:dict = __import__('json').load(f)
+except JSONDecodeError:
+    log.critical('failed to load config file')
+    exit(1)
+
+# update loglist
+log.remove_loglist(*CONFIG.get('log')['remove'])
+
+DB_PATH = CONFIG.get('db')['path']
+TABLES = CONFIG.get('db')['tables']
+SEARCH_TABLE = TABLES.get('search', 'blogs_fts')
+BATCH_SIZE = CONFIG.get('import', {}).get('batch_size', 500)
+PROCESSES = CONFIG.get('import', {}).get('processes') # None = number of cpus
+ROUNDS = CONFIG.get('bcrypt', {}).get('rounds', 12)
+
+
+def _hash_password(password:str) -> str:
+    """Hash password in a worker process."""
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(ROUNDS)).decode()
+
+
+def _batches(items:list, size:int):
+    """Split items into lists of size."""
+    for i in range(0, len(items), size): yield items[i:i + size]
+
+
+def _parse_blog(text:str) -> tuple:
+    """
+    Split front matter from markdown, returns (meta, body).
+    ---
+    title: Title
+    author: author@mail
+    tags: tag1,tag2
+    ---
+    """
+    if not text.startswith('---\n'): return dict(), text
+    head, sep, body = text[4:].partition('\n---\n')
+    if not sep: return dict(), text
+    meta = dict()
+    for line in head.splitlines():
+        key, _, value = line.partition(':')
+        meta[key.strip().lower()] = value.strip()
+    return meta, body.lstrip('\n')
+
+
+def import_users(path:str, processes:int|None = PROCESSES) -> tuple:
+    """
+    Import users from csv with the columns realname, email, username and password or password_hash.
+    Users whose email already exists are skipped, so an interrupted import can be resumed.
+    Rows without password are rejected, they would create a login with an empty password.
+    Returns number of imported and rejected users.
+    """
+    with open(path, 'r', newline='') as f:
+        users = [row for row in DictReader(f) if row.get('email')]
+    rejected = [user for user in users if not user.get('password') and not user.get('password_hash')]
+    for user in rejected: log.warning(f'rejected user: {user["email"]}: no password')
+    users = [user for user in users if user.get('password') or user.get('password_hash')]
+    db = DB(DB_PATH)
+    imported = 0
+    start = perf_counter()
+    with ProcessPoolExecutor(processes, get_context('spawn')) as pool:
+        for batch in _batches(users, BATCH_SIZE):
+            emails = tuple(user['email'] for user in batch)
+            existing = {row[0] for row in db.select(TABLES['user-data'], 'email', f'WHERE email IN ({", ".join("?" * len(emails))})', emails) or ()}
+            batch = [user for user in batch if user['email'] not in existing]
+            if not batch: continue
+            # hash passwords in parallel, existing hashes are taken as they are
+            plain = [user for user in batch if not user.get('password_hash')]
+            for user, password_hash in zip(plain, pool.map(_hash_password, (user['password'] for user in plain), chunksize=16)):
+                user['password_hash'] = password_hash
+            rows = []
+            for user in batch:
+                name = (user.get('realname') or user['username']).split()
+                rows.append((
+                    sha256(f'{user["password_hash"]}{user["username"]}{uuid4().hex}'.encode()).hexdigest(),
+                    name[0], ' '.join(name[1:]) if len(name) > 1 else None,
+                    user['email'], user['username'], user['password_hash'],
+                ))
+            imported += db.insert_many(TABLES['user-data'], ('unique_id', 'firstname', 'lastname', 'email', 'username', 'password'), rows, ignore=True)
+            log.info(f'imported {imported} users ({imported / (perf_counter() - start):.0f} rows/s)')
+    db.close()
+    return imported, len(rejected)
+
+
+def import_blogs(directory:str) -> tuple:
+    """
+    Import markdown files with front matter (title, author email, tags) from directory.
+    Blogs that already exist are skipped, so an interrupted import can be resumed.
+    Returns number of imported and skipped blogs.
+    """
+    from src.functions import save_tags
+    files = sorted(i for i in listdir(directory) if i.endswith('.md'))
+    db = DB(DB_PATH)
+    imported, skipped = 0, 0
+    start = perf_counter()
+    for batch in _batches(files, BATCH_SIZE):
+        blogs = []
+        for file in batch:
+            with open(f'{directory}/{file}', 'r') as f:
+                meta, body = _parse_blog(f.read())
+            blogs.append((meta.get('title') or file.removesuffix('.md'), meta.get('author', ''), meta.get('tags', ''), body))
+        
+        # authors of batch
+        emails = tuple({blog[1] for blog in blogs})
+        authors = {row[0]: row[1:] for row in db.select(TABLES['user-data'], ('email', 'unique_id', 'username'), f'WHERE email IN ({", ".join("?" * len(emails))})', emails) or ()}
+        rows, search_rows = [], []
+        batch_keys = set() # blogs(unique_id, title) isn't unique and blogs of this batch aren't in the db yet
+        for title, email, tags, body in blogs:
+            if email not in authors or not title or '/' in title:
+                log.warning(f'skipped blog: {title}: unknown author or invalid title')
+                skipped += 1
+                continue
+            uid, username = authors[email]
+            if db.select(TABLES['blog'], 'id', 'WHERE unique_id = ? AND title = ?', (uid, title)) is not None: 
+                continue # imported before
+            if (uid, title) in batch_keys:
+                log.warning(f'skipped blog: {title}: duplicate title of author')
+                skipped += 1
+                continue
+            batch_keys.add((uid, title))
+            # write file first, a crash before the commit only leaves a file that is overwritten on resume
+            storage.write(f'{uid}_{title}', body)
+            rows.append((uid, username, title, tags))
+            search_rows.append((uid, title, tags, body))
+        if not rows: continue
+        
+        # blog rows, tags and search index in one transaction
+        db.insert_many(TABLES['blog'], ('unique_id', 'username', 'title', 'tags'), rows, commit=False)
+        for uid, _, title, tags in rows:
+            save_tags(db, db.select(TABLES['blog'], 'id', 'WHERE unique_id = ? AND title = ?', (uid, title))[0][0], tags)
+        db.insert_many(SEARCH_TABLE, ('unique_id', 'title', 'tags', 'body'), search_rows)
+        imported += len(rows)
+        log.info(f'imported {imported} blogs ({imported / (perf_counter() - start):.0f} rows/s)')
+    db.close()
+    return imported, skipped
+
+
+def import_data(directory:str) -> None:
+    """Import users.csv and the blogs directory of directory, both are optional."""
+    start = perf_counter()
+    users, rejected = import_users(f'{directory}/users.csv') if exists(f'{directory}/users.csv') else (0, 0)
+    blogs, skipped = import_blogs(f'{directory}/blogs') if exists(f'{directory}/blogs') else (0, 0)
+    took = perf_counter() - start
+    log.info(f'import finished in {took:.1f} s: {users} users, {rejected} users rejected, {blogs} blogs, {skipped} blogs skipped ({(users + blogs) / took if took else 0:.0f} rows/s)')
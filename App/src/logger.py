@@ -1,6 +1,23 @@
 from datetime import datetime
 from src.exception import TypeNameLogError
 from inspect import stack
+from queue import SimpleQueue
+from threading import Thread
+from os import rename, remove, stat, fstat
+from os.path import exists
+from time import time
+from json import dumps
+import atexit
+
+try: import fcntl
+except ImportError: # windows, only one process writes the log there
+    fcntl = None
+
+try: from os import register_at_fork
+except ImportError: # windows, processes aren't forked there
+    register_at_fork = None
+
+TYPENAMES = ('info', 'debug', 'warning', 'error', 'critical')
 
 class Colors:
     """ANSI color codes"""
@@ -34,6 +51,105 @@ class Colors:
 colors = Colors()
 
 
+class Writer:
+    def __init__(self) -> None:
+        """Write log records from a queue in a background thread, so logging never blocks the caller."""
+        self.format = 'text'
+        self.file = None
+        self.max_bytes = 10 * 1024 * 1024
+        self.backups = 5
+        self._start()
+        if register_at_fork is not None: register_at_fork(after_in_child=self._start) # threads don't survive a fork
+        atexit.register(self.close)
+
+    def _start(self) -> None:
+        """Start writer thread with an empty queue."""
+        self._queue = SimpleQueue()
+        self._stream = None
+        self._thread = Thread(target=self._run, name='log-writer', daemon=True)
+        self._thread.start()
+
+    def configure(self, format:str = 'text', file:str|None = None, max_bytes:int = 10 * 1024 * 1024, backups:int = 5) -> None:
+        """
+        Configure output of all loggers.
+        format: text/json (one json object per line)
+        file: write to file instead of the console, rotated after max_bytes
+        """
+        self.put(('configure', format, file, max_bytes, backups)) # applied in order with queued records
+
+    def put(self, record:tuple) -> None:
+        """Queue record for writing."""
+        self._queue.put(record)
+
+    def close(self) -> None:
+        """Write queued records and stop writer thread."""
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+    def _run(self) -> None:
+        """Write records until closed."""
+        while (record := self._queue.get()) is not None:
+            try:
+                if record[0] == 'configure': 
+                    _, self.format, self.file, self.max_bytes, self.backups = record
+                    if self._stream is not None: self._stream.close()
+                    self._stream = None
+                else: self._write(*record)
+            except Exception as e: 
+                print(f'failed to write log: {e.__str__()}')
+        if self._stream is not None: self._stream.close()
+
+    def _write(self, logger, created:float, typename:str, msg:str) -> None:
+        """Format and write a single record."""
+        if self.format == 'json':
+            line = dumps({
+                'time': datetime.fromtimestamp(created).isoformat(),
+                'type': typename,
+                'name': logger.name,
+                'file': logger.file,
+                'msg': str(msg),
+            })
+        else: line = logger._build_message(msg, typename, created)
+
+        if self.file is None:
+            print(logger._color(line, typename) if self.format != 'json' else line)
+            return
+        if self._stream is None or self._moved():
+            self._reopen()
+        if self.max_bytes and self._stream.tell() + len(line) >= self.max_bytes:
+            self._rotate(len(line))
+        self._stream.write(line + '\n')
+        self._stream.flush()
+
+    def _moved(self) -> bool:
+        """Return True if the file was rotated by another process, worker processes share the log file."""
+        try: return stat(self.file).st_ino != fstat(self._stream.fileno()).st_ino
+        except FileNotFoundError: return True
+
+    def _reopen(self) -> None:
+        """Open the current log file."""
+        if self._stream is not None: self._stream.close()
+        self._stream = open(self.file, 'a')
+
+    def _rotate(self, size:int) -> None:
+        """
+        Move log files one number up and start a new file.
+        Processes rotate one after another, a process that comes second only opens the new file.
+        """
+        with open(f'{self.file}.lock', 'a') as lock:
+            if fcntl is not None: fcntl.flock(lock, fcntl.LOCK_EX) # released on close
+            if self._moved() or stat(self.file).st_size + size < self.max_bytes: return self._reopen()
+            self._stream.close()
+            if exists(f'{self.file}.{self.backups}'): remove(f'{self.file}.{self.backups}')
+            for i in range(self.backups - 1, 0, -1):
+                if exists(f'{self.file}.{i}'): rename(f'{self.file}.{i}', f'{self.file}.{i + 1}')
+            if self.backups > 0: rename(self.file, f'{self.file}.1')
+            else: remove(self.file)
+            self._stream = open(self.file, 'a')
+
+writer = Writer()
+
+
 class Logger:
     def __init__(self, name:str) -> None:
         """Initialize logger and only log messages in loglist."""
@@ -42,9 +158,10 @@ class Logger:
         self._loglist = ['info', 'debug', 'warning', 'error', 'critical']
         self._active = True
     
-    def _build_message(self, msg:str, typename:str) -> str:
+    def _build_message(self, msg:str, typename:str, created:float|None = None) -> str:
         """Build log string."""
-        return f'[{datetime.now().strftime("%d.%m.%Y|%H:%M:%S")}]-[{typename.upper()}]-[{self.name}]-[{self.file}]: {msg}'
+        when = datetime.now() if created is None else datetime.fromtimestamp(created)
+        return f'[{when.strftime("%d.%m.%Y|%H:%M:%S")}]-[{typename.upper()}]-[{self.name}]-[{self.file}]: {msg}'
 
     def _color(self, logmsg:str, typename:str) -> str:
         """Color log message."""
@@ -61,10 +178,13 @@ class Logger:
         Log message.
         typenames: info/debug/warning/error/critical
         """
-        msg = self._build_message(msg, typename)
-        msg = self._color(msg, typename)
-        if typename in self._loglist and self._active:
-            print(msg)
+        if typename not in TYPENAMES: raise TypeNameLogError(typename)
+        if typename in self._loglist and self._active: # check before spending time on formatting
+            writer.put((self, time(), typename, msg))
+    
+    def enabled(self, typename:str) -> bool:
+        """Return True if messages of typename are logged."""
+        return typename in self._loglist and self._active
     
     def remove_loglist(self, *args:str) -> None:
         """
@@ -0,0 +1,206 @@
+from src.logger import Logger
+from threading import Lock, Thread
+from time import sleep
+from os import getpid, kill, listdir, makedirs, remove, replace
+from os.path import exists
+from json import dump, load, JSONDecodeError
+import atexit
+
+log = Logger('MetricsLog')
+
+try:
+    with open('./config.json', 'r') as f:
+        CONFIG:dict = __import__('json').load(f)
+except JSONDecodeError:
+    log.critical('failed to load config file')
+    exit(1)
+
+# update loglist
+log.remove_loglist(*CONFIG.get('log')['remove'])
+
+
+def _labels(**labels) -> str:
+    """Format labels for the prometheus text format."""
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels.items()) + '}'
+
+
+def _alive(pid:int) -> bool:
+    """Check if process is still running."""
+    try: kill(pid, 0)
+    except ProcessLookupError: return False
+    except PermissionError: pass
+    return True
+
+
+class Metrics:
+    def __init__(self, directory:str = 'metrics', buckets:tuple|list = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5), flush_interval:float = 1) -> None:
+        """
+        Request metrics of this process, shared with other worker processes through snapshot files in directory.
+        Snapshots are written every flush_interval seconds while requests come in.
+        sources: name -> function returning a dict of numbers, e.g. cache stats, keys ending with _total are exported as counters
+        reports: name -> function returning json data, collected from all processes with collect()
+        """
+        self.directory = directory
+        self.buckets = tuple(sorted(buckets))
+        self.flush_interval = flush_interval
+        self.sources = dict()
+        self.reports = dict()
+        self._requests = dict() # (route, method, status) -> count
+        self._latency = dict() # route -> [count per bucket..., count, sum]
+        self._queries = dict() # route -> db queries
+        self._in_flight = 0
+        self._lock = Lock()
+        self._dirty = False
+        self._flusher = None # pid of process running the flush thread
+        atexit.register(self.flush)
+
+
+    def clear_directory(self) -> None:
+        """Remove snapshots of earlier runs, call once before workers start."""
+        if exists(self.directory):
+            for file in listdir(self.directory):
+                if file.endswith('.json'): remove(f'{self.directory}/{file}')
+
+
+    def start(self) -> None:
+        """Count request as in flight."""
+        if self._flusher != getpid(): self._start_flusher()
+        with self._lock: 
+            self._in_flight += 1
+            self._dirty = True
+
+
+    def finish(self) -> None:
+        """Request is no longer in flight."""
+        with self._lock: 
+            self._in_flight -= 1
+            self._dirty = True
+
+
+    def _start_flusher(self) -> None:
+        """Start thread writing snapshots of this process, forked workers need their own."""
+        with self._lock:
+            if self._flusher == getpid(): return
+            self._flusher = getpid()
+        Thread(target=self._flush_loop, name='metrics-flush', daemon=True).start()
+
+
+    def _flush_loop(self) -> None:
+        """Write snapshot whenever metrics changed."""
+        while True:
+            sleep(self.flush_interval)
+            if self._dirty: self.flush()
+
+
+    def record(self, route:str, method:str, status:int, seconds:float, queries:int) -> None:
+        """Record finished request."""
+        with self._lock:
+            key = (route, method, status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            latency = self._latency.setdefault(route, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound: latency[i] += 1
+            latency[-2] += 1
+            latency[-1] += seconds
+            self._queries[route] = self._queries.get(route, 0) + queries
+
+
+    def snapshot(self) -> dict:
+        """Return metrics of this process."""
+        with self._lock:
+            snapshot = {
+                'pid': getpid(),
+                'requests': [[*key, count] for key, count in self._requests.items()],
+                'latency': {route: list(values) for route, values in self._latency.items()},
+                'queries': dict(self._queries),
+                'in_flight': self._in_flight,
+            }
+        snapshot['sources'] = dict()
+        for name, func in self.sources.items():
+            try: snapshot['sources'][name] = func()
+            except Exception as e: log.warning(f'failed to collect metrics of: {name}: {e.__str__()}')
+        snapshot['reports'] = dict()
+        for name, func in self.reports.items():
+            try: snapshot['reports'][name] = func()
+            except Exception as e: log.warning(f'failed to collect report: {name}: {e.__str__()}')
+        return snapshot
+
+
+    def flush(self) -> None:
+        """Write snapshot of this process for the other workers."""
+        self._dirty = False
+        try:
+            makedirs(self.directory, exist_ok=True)
+            path = f'{self.directory}/{getpid()}.json'
+            with open(f'{path}.tmp', 'w') as f:
+                dump(self.snapshot(), f)
+            replace(f'{path}.tmp', path) # readers never see half written files
+        except Exception as e:
+            log.warning(f'failed to write metrics snapshot: {e.__str__()}')
+
+
+    def _snapshots(self) -> list:
+        """Snapshots of all processes, this process is always up to date."""
+        snapshots = [self.snapshot()]
+        if not exists(self.directory): return snapshots
+        for file in listdir(self.directory):
+            if not file.endswith('.json') or file == f'{getpid()}.json': continue
+            try:
+                with open(f'{self.directory}/{file}', 'r') as f:
+                    snapshots.append(load(f))
+            except (OSError, JSONDecodeError): continue
+        return snapshots
+
+
+    def collect(self, name:str) -> list:
+        """Return report of all processes, including finished ones."""
+        return [snapshot['reports'][name] for snapshot in self._snapshots() if name in snapshot.get('reports', {})]
+
+
+    def render(self) -> str:
+        """Return metrics of all processes in the prometheus text format."""
+        requests, latency, queries, in_flight, sources = dict(), dict(), dict(), 0, dict()
+        for snapshot in self._snapshots():
+            # counters of finished processes still count, gauges only of running ones
+            for route, method, status, count in snapshot['requests']:
+                requests[(route, method, status)] = requests.get((route, method, status), 0) + count
+            for route, values in snapshot['latency'].items():
+                if len(values) != len(self.buckets) + 2: continue
+                latency[route] = [a + b for a, b in zip(latency.get(route, [0] * len(values)), values)]
+            for route, count in snapshot['queries'].items():
+                queries[route] = queries.get(route, 0) + count
+            alive = snapshot['pid'] == getpid() or _alive(snapshot['pid'])
+            if alive: in_flight += snapshot['in_flight']
+            for name, stats in snapshot['sources'].items():
+                summed = sources.setdefault(name, dict())
+                for key, value in stats.items():
+                    if key == 'ratio' or key.startswith('avg'): continue # recalculated from the sums
+                    if not alive and not key.endswith('_total'): continue
+                    summed[key] = max(summed.get(key, 0), value) if key.startswith('max') else summed.get(key, 0) + value
+
+        lines = ['# HELP webapp_requests_total Finished requests.', '# TYPE webapp_requests_total counter']
+        lines += [f'webapp_requests_total{_labels(route=r, method=m, status=s)} {c}' for (r, m, s), c in sorted(requests.items())]
+        lines += ['# HELP webapp_request_duration_seconds Request latency.', '# TYPE webapp_request_duration_seconds histogram']
+        for route, values in sorted(latency.items()):
+            lines += [f'webapp_request_duration_seconds_bucket{_labels(route=route, le=b)} {values[i]}' for i, b in enumerate(self.buckets)]
+            lines.append(f'webapp_request_duration_seconds_bucket{_labels(route=route, le="+Inf")} {values[-2]}')
+            lines.append(f'webapp_request_duration_seconds_sum{_labels(route=route)} {values[-1]}')
+            lines.append(f'webapp_request_duration_seconds_count{_labels(route=route)} {values[-2]}')
+        lines += ['# HELP webapp_db_queries_total Database queries executed by requests.', '# TYPE webapp_db_queries_total counter']
+        lines += [f'webapp_db_queries_total{_labels(route=r)} {c}' for r, c in sorted(queries.items())]
+        lines += ['# HELP webapp_requests_in_flight Requests being handled.', '# TYPE webapp_requests_in_flight gauge', f'webapp_requests_in_flight {in_flight}']
+        for name, stats in sorted(sources.items()):
+            for key, value in sorted(stats.items()):
+                lines += [f'# TYPE webapp_{name}_{key} {"counter" if key.endswith("_total") else "gauge"}', f'webapp_{name}_{key} {value}']
+            if 'hits_total' in stats and 'misses_total' in stats:
+                total = stats['hits_total'] + stats['misses_total']
+                lines += [f'# TYPE webapp_{name}_hit_ratio gauge', f'webapp_{name}_hit_ratio {stats["hits_total"] / total if total else 0.0}']
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics(
+    CONFIG.get('metrics', {}).get('dir', 'metrics'),
+    CONFIG.get('metrics', {}).get('buckets', (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)),
+    CONFIG.get('metrics', {}).get('flush_interval', 1)
+)
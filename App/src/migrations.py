@@ -0,0 +1,114 @@
+from src.logger import Logger
+from src.sql import DB
+from src.exception import JSONDecodeError
+from datetime import datetime
+
+log = Logger('MigrationLog')
+
+try:
+    with open('./config.json', 'r') as f:
+        CONFIG:dict = __import__('json').load(f)
+except JSONDecodeError:
+    log.critical('failed to load config file')
+    exit(1)
+
+# update loglist
+log.remove_loglist(*CONFIG.get('log')['remove'])
+
+MIGRATION_TABLE = 'schema_migrations'
+TABLES = {
+    'user': CONFIG.get('db')['tables']['user-data'],
+    'session': CONFIG.get('db')['tables']['session'],
+    'blog': CONFIG.get('db')['tables']['blog'],
+    'search': CONFIG.get('db')['tables'].get('search', 'blogs_fts'),
+    'tag': CONFIG.get('db')['tables'].get('tag', 'blog_tags'),
+    'tag_count': CONFIG.get('db')['tables'].get('tag_count', 'tag_counts'),
+}
+
+
+def _fill_search_index(db:DB) -> None:
+    """Index blogs that were written before the search index existed."""
+    from src.functions import fill_search_index
+    fill_search_index(db)
+
+
+def _fill_profile_index(db:DB) -> None:
+    """Record profile images that were uploaded before the users table had the columns."""
+    from src.functions import fill_profile_index
+    fill_profile_index(db)
+
+
+def _fill_tag_index(db:DB) -> None:
+    """Tag blogs that were written before the tag table existed."""
+    from src.functions import fill_tag_index
+    fill_tag_index(db)
+
+
+# applied in order, the version of a migration is its position in the tuple
+# steps are sql statements with table names as {placeholders} or functions taking the db
+MIGRATIONS = (
+    ('session indexes', (
+        'CREATE INDEX IF NOT EXISTS sessions_session_id ON {session} (session_id);',
+        'CREATE INDEX IF NOT EXISTS sessions_expiration ON {session} (expiration);',
+    )),
+    ('blog indexes', (
+        'CREATE INDEX IF NOT EXISTS blogs_unique_id_title ON {blog} (unique_id, title);',
+    )),
+    ('search index', (
+        'CREATE VIRTUAL TABLE IF NOT EXISTS {search} USING fts5(unique_id UNINDEXED, title, tags, body);',
+        _fill_search_index,
+    )),
+    ('profile image index', (
+        'ALTER TABLE {user} ADD COLUMN profile_img text;', # png, jpeg or NULL for the default image
+        'ALTER TABLE {user} ADD COLUMN profile_img_version integer;', # NULL if there are no webp variants
+        _fill_profile_index,
+    )),
+    ('blog author index', (
+        'CREATE INDEX IF NOT EXISTS blogs_unique_id ON {blog} (unique_id);', # ordered by id per author for paging
+    )),
+    ('tag index', (
+        'CREATE TABLE IF NOT EXISTS {tag} (tag text NOT NULL, blog_id integer NOT NULL, PRIMARY KEY (tag, blog_id)) WITHOUT ROWID;',
+        'CREATE INDEX IF NOT EXISTS blog_tags_blog_id ON {tag} (blog_id);',
+        'CREATE TABLE IF NOT EXISTS {tag_count} (tag text PRIMARY KEY, count integer NOT NULL);',
+        'CREATE INDEX IF NOT EXISTS tag_counts_count ON {tag_count} (count);',
+        # counts follow the tag table, nothing has to be recounted
+        """CREATE TRIGGER IF NOT EXISTS blog_tags_insert AFTER INSERT ON {tag} BEGIN
+            INSERT INTO {tag_count} (tag, count) VALUES (new.tag, 1) ON CONFLICT (tag) DO UPDATE SET count = count + 1;
+        END;""",
+        """CREATE TRIGGER IF NOT EXISTS blog_tags_delete AFTER DELETE ON {tag} BEGIN
+            UPDATE {tag_count} SET count = count - 1 WHERE tag = old.tag;
+            DELETE FROM {tag_count} WHERE tag = old.tag AND count <= 0;
+        END;""",
+        _fill_tag_index,
+    )),
+)
+
+
+def current_version(db:DB) -> int:
+    """Return version of the newest applied migration."""
+    if MIGRATION_TABLE not in (i[0] for i in db.list_tables() if i):
+        db.create_table(MIGRATION_TABLE, (
+            'version integer PRIMARY KEY',
+            'name text NOT NULL',
+            'applied timestamp NOT NULL',
+        ))
+    return db.execute(f'SELECT max(version) FROM {MIGRATION_TABLE};')[0][0] or 0
+
+
+def migrate(db:DB) -> int:
+    """Apply pending migrations, each in its own transaction. Returns number of applied migrations."""
+    version = current_version(db)
+    for number, (name, steps) in enumerate(MIGRATIONS[version:], start=version + 1):
+        log.info(f'applying migration {number}: {name}')
+        try:
+            db.execute('BEGIN;')
+            for step in steps:
+                if callable(step): step(db)
+                else: db.execute(step.format(**TABLES))
+            db.execute(f'INSERT INTO {MIGRATION_TABLE} (version, name, applied) VALUES (?, ?, ?);', (number, name, datetime.now()))
+            db.commit()
+        except Exception as e:
+            db.conn.rollback()
+            log.error(f'migration {number} failed: {e.__str__()}')
+            raise e
+    return len(MIGRATIONS) - version
@@ -0,0 +1,116 @@
+from src.logger import Logger
+from src.exception import JSONDecodeError
+from hashlib import blake2b
+from threading import Lock
+from os import getpid
+from time import time
+import mmap
+import struct
+
+try: 
+    import fcntl
+    from os import register_at_fork
+except ImportError: # windows, the buckets aren't shared between processes then
+    fcntl = None
+
+log = Logger('LimitLog')
+
+try:
+    with open('./config.json', 'r') as f:
+        CONFIG:dict = __import__('json').load(f)
+except JSONDecodeError:
+    log.critical('failed to load config file')
+    exit(1)
+
+# update loglist
+log.remove_loglist(*CONFIG.get('log')['remove'])
+
+SLOT = struct.Struct('<Qdd') # key hash, tokens, last update
+PROBES = 8 # slots searched for a key
+
+
+class RateLimiter:
+    def __init__(self, path:str|None = None, slots:int = 4096) -> None:
+        """
+        Token buckets in a fixed size hash table, kept in the memory mapped file path to share them between worker processes.
+        If the table is full, the bucket with the oldest update is reused.
+        """
+        self.path = path
+        self.slots = slots
+        self._lock = Lock()
+        self._pid = None
+        self._stats = {'allowed_total': 0, 'throttled_total': 0}
+        if fcntl is not None: register_at_fork(after_in_child=self._reset)
+
+
+    def _reset(self) -> None:
+        """The lock may have been held by another thread at fork, the table is mapped again on first use."""
+        self._lock = Lock()
+        self._pid = None
+
+
+    def _open(self) -> None:
+        """Map the table, again in forked processes since the file lock belongs to the open file."""
+        size = self.slots * SLOT.size
+        if self.path is None or fcntl is None:
+            self._file, self._map = None, mmap.mmap(-1, size)
+        else:
+            self._file = open(self.path, 'a+b')
+            if self._file.seek(0, 2) < size: self._file.truncate(size)
+            self._map = mmap.mmap(self._file.fileno(), size)
+        self._pid = getpid()
+
+
+    def _slot(self, digest:int, taken:set) -> int|None:
+        """
+        Index of the bucket of digest, a free or the oldest slot if it has none. Slots in taken belong to other keys.
+        Returns None if all probed slots are taken, only possible with a table smaller than the number of keys.
+        """
+        oldest = None
+        for i in range(PROBES):
+            index = (digest + i) % self.slots
+            if index in taken: continue
+            found, _, updated = SLOT.unpack_from(self._map, index * SLOT.size)
+            if found == digest or found == 0: return index
+            if oldest is None or updated < oldest[1]: oldest = (index, updated)
+        return oldest[0] if oldest is not None else None
+
+
+    def acquire(self, *buckets:tuple) -> float:
+        """
+        Take a token of every bucket given as (key, rate, burst), but only if all of them have one.
+        Returns 0 if the tokens were taken or else the seconds until all buckets have one again.
+        """
+        if any(rate <= 0 for _, rate, _ in buckets): raise ValueError('rate of a bucket has to be above 0')
+        digests = [int.from_bytes(blake2b(key.encode(), digest_size=8).digest(), 'little') or 1 for key, _, _ in buckets] # 0 marks free slots
+        with self._lock:
+            if self._pid != getpid(): self._open()
+            if self._file is not None: fcntl.flock(self._file, fcntl.LOCK_EX)
+            try:
+                now = time()
+                state = []
+                for digest, (_, rate, burst) in zip(digests, buckets):
+                    slot = self._slot(digest, {i[0] for i in state})
+                    found, tokens, updated = SLOT.unpack_from(self._map, slot * SLOT.size) if slot is not None else (None, 0, 0)
+                    if found != digest: tokens, updated = burst, now # new bucket starts full
+                    state.append((slot, digest, min(burst, tokens + (now - updated) * rate), rate))
+                wait = max((0 if tokens >= 1 else (1 - tokens) / rate for _, _, tokens, rate in state), default=0)
+                for slot, digest, tokens, _ in state: # a bucket that allows doesn't pay for one that throttles
+                    if slot is None: continue # no room, the key goes unlimited
+                    SLOT.pack_into(self._map, slot * SLOT.size, digest, tokens - 1 if not wait else tokens, now)
+            finally:
+                if self._file is not None: fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._stats['throttled_total' if wait else 'allowed_total'] += 1
+        return wait
+
+
+    def stats(self) -> dict:
+        """Return counters of this process."""
+        with self._lock:
+            return dict(self._stats)
+
+
+login_limiter = RateLimiter(
+    CONFIG.get('limits', {}).get('path', 'db/login_limits'),
+    CONFIG.get('limits', {}).get('slots', 4096)
+)
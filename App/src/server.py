@@ -0,0 +1,33 @@
+from gunicorn.app.base import BaseApplication
+from flask import Flask
+from src.logger import Logger
+
+log = Logger('ServerLog')
+
+
+class ProductionServer(BaseApplication):
+    def __init__(self, app:Flask, options:dict, on_ready=None) -> None:
+        """
+        Pre-forked pool of worker processes, each serving requests with a thread pool.
+        options: gunicorn settings, e.g. {'bind': '0.0.0.0:8080', 'workers': 4, ...}
+        on_ready: called once in the master process when the server is ready, e.g. to start background threads
+        """
+        self.application = app
+        self.options = options
+        self.on_ready = on_ready
+        super().__init__()
+
+
+    def load_config(self) -> None:
+        """Apply options to the gunicorn config."""
+        for key, value in self.options.items():
+            if key in self.cfg.settings and value is not None:
+                self.cfg.set(key, value)
+            else: log.warning(f'unknown server option: {key}')
+        if self.on_ready is not None:
+            self.cfg.set('when_ready', lambda server: self.on_ready())
+
+
+    def load(self) -> Flask:
+        """Return the application served by the workers."""
+        return self.application
@@ -1,6 +1,7 @@
 from src.logger import Logger
 from src.sql import DB
-from src.exception import IntegrityError, JSONDecodeError, NoSessionError
+from src.cache import TTLCache, Generation
+from src.exception import JSONDecodeError, NoSessionError
 from time import sleep
 from datetime import datetime
 
@@ -18,6 +19,19 @@ log.remove_loglist(*CONFIG.get('log')['remove'])
 
 DB_PATH = CONFIG.get('db')['path']
 TABLES = CONFIG.get('db')['tables']
+SESSION_COLUMNS = ('unique_id', 'session_id', 'expiration', 'username', 'email', 'realname')
+USER_COLUMNS = ('profile_img', 'profile_img_version') # cached with the session, so the own profile needs no query
+
+# cache of session rows, entries never outlive the session itself
+session_cache = TTLCache(
+    CONFIG.get('cache', {}).get('session', {}).get('max_size', 1024),
+    CONFIG.get('cache', {}).get('session', {}).get('ttl', 60)
+)
+# bumped per session on logout, session rotation and profile image changes, outdates its cached row in all worker processes
+session_generation = Generation(
+    CONFIG.get('cache', {}).get('session', {}).get('generation_path', 'db/session_generation'),
+    CONFIG.get('cache', {}).get('session', {}).get('generation_slots', 16384)
+)
 
 
 def add_session(unique_id:str, session_id:str, expires:datetime, username:str, email:str, realname:str) -> None:
@@ -31,39 +45,85 @@ def add_session(unique_id:str, session_id:str, expires:datetime, username:str, e
         'email': email,
         'realname': realname,
     }
-    try: db.insert(TABLES['session'], data)
-    except IntegrityError:
-        log.debug(f'update session: {session_id}')
-        db.delete(TABLES['session'], f'WHERE unique_id = "{unique_id}"')
-        db.insert(TABLES['session'], data)
+    def replace(cursor) -> str|None:
+        """Replace old session of user in one write, returns its id."""
+        old = cursor.execute(f'SELECT session_id FROM {TABLES["session"]} WHERE unique_id = ?;', (unique_id, )).fetchone()
+        cursor.execute(
+            f'INSERT INTO {TABLES["session"]} ({", ".join(data)}) VALUES ({", ".join("?" * len(data))}) '
+            f'ON CONFLICT (unique_id) DO UPDATE SET {", ".join(f"{key} = excluded.{key}" for key in data if key != "unique_id")};',
+            tuple(data.values())
+        )
+        return old[0] if old else None
+    old_session = db.transaction(replace)
     db.close()
+    if old_session is not None and old_session != session_id: # old session may be cached by other workers
+        session_cache.invalidate(old_session)
+        session_generation.bump(old_session)
 
 
 def remove_session(session_id:str) -> None:
     """Remove session cookie from db."""
+    session_cache.invalidate(session_id)
     db = DB(DB_PATH)
-    try: db.delete(TABLES['session'], f'WHERE session_id = "{session_id}"')
+    try: deleted = db.delete(TABLES['session'], f'WHERE session_id = "{session_id}"')
     except TypeError: raise NoSessionError
     finally: db.close()
+    if deleted: session_generation.bump(session_id) # session may be cached by other workers
+
+
+def refresh_user_session(unique_id:str) -> None:
+    """Outdate the cached session row of user after its data changed."""
+    session_cache.invalidate_where(lambda entry: entry[1]['unique_id'] == unique_id)
+    db = DB(DB_PATH)
+    try: sessions = db.select(TABLES['session'], 'session_id', 'WHERE unique_id = ?', (unique_id, )) or ()
+    finally: db.close()
+    for session_id, in sessions: session_generation.bump(session_id) # row may be cached by other workers
 
 
 def get_session_data(session_id:str, data:str|tuple) -> tuple:
     """Return requested data of session or raise NoSessionError if session doesn't exist."""
-    db = DB(DB_PATH)
+    if session_id is None: raise NoSessionError
     data = (data, ) if type(data) == str else data # handle string type
-    try: return db.select(TABLES['session'], data, f'WHERE session_id = "{session_id}"')[0]
-    except TypeError: raise NoSessionError
-    finally: db.close()
+    generation = session_generation.value(session_id) # read before the db, a removal after it bumps the generation again
+    generation_cached, row = session_cache.get(session_id, (None, None))
+    if generation_cached != generation:
+        db = DB(DB_PATH)
+        try: 
+            row = dict(zip(SESSION_COLUMNS, db.select(TABLES['session'], SESSION_COLUMNS, f'WHERE session_id = "{session_id}" AND expiration > ?', (str(datetime.now()), ))[0]))
+            row.update(zip(USER_COLUMNS, (db.select(TABLES['user-data'], USER_COLUMNS, 'WHERE unique_id = ?', (row['unique_id'], )) or ((None, None), ))[0]))
+        except TypeError: raise NoSessionError
+        finally: db.close()
+        session_cache.set(session_id, (generation, row), _seconds_left(row['expiration'])) # swept sessions can't stay cached
+    return tuple(row[i] for i in data)
+
+
+def _seconds_left(expiration:str|None) -> float:
+    """Seconds until session expires."""
+    try: return (datetime.fromisoformat(str(expiration)) - datetime.now()).total_seconds()
+    except ValueError: return 0
 
 
 def session_cleanup(sleep_time: int) -> None:
-    """Clean session table by expired cookies."""
+    """
+    Clean session table by expired cookies.
+    Deletes in small batches, so writers never wait long for the lock.
+    """
+    batch_size = CONFIG.get('vars').get('session_cleanup_batch', 500)
+    batch_pause = CONFIG.get('vars').get('session_cleanup_pause', 0.05)
     while True:
         try: sleep(sleep_time)
         except Exception as e: 
             log.warning(f'session cleanup process stopped due exception: {e}')
             break
-        db = DB(CONFIG.get('db')['path'])
-        db.delete(CONFIG.get('db')['tables']['session'], f'WHERE expiration < ?', (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), )) # delete expired sessions
-        db.close()
+        now = str(datetime.now())
+        deleted = batch_size
+        while deleted >= batch_size: # delete expired sessions
+            db = DB(CONFIG.get('db')['path'])
+            deleted = db.delete(
+                CONFIG.get('db')['tables']['session'], 
+                f'WHERE id IN (SELECT id FROM {CONFIG.get("db")["tables"]["session"]} WHERE expiration < ? LIMIT ?)', 
+                (now, batch_size)
+            )
+            db.close()
+            sleep(batch_pause)
         log.debug('cleared expired sessions')
@@ -1,8 +1,20 @@
-from sqlite3 import connect
+from sqlite3 import connect, Connection
 from os.path import exists
+from os import getpid, remove
+from threading import local, Lock, Thread
+from queue import SimpleQueue, Empty
+from concurrent.futures import Future
+from functools import lru_cache
+from datetime import datetime
+from time import perf_counter
+import re
 from src.logger import Logger
 from src.exception import TableExistError, DBConnectionFailedError, JSONDecodeError
 
+try: from os import register_at_fork
+except ImportError: # windows, processes aren't forked there
+    register_at_fork = None
+
 log = Logger('SQLog')
 
 try:
@@ -16,12 +28,259 @@ try: log.remove_loglist(*CONFIG.get('log')['remove'])
 except NameError: log.warning('couldn\'t update the loglist')
 
 
+class Pool:
+    def __init__(self, pragmas:dict|None = None, max_idle:int = 8) -> None:
+        """
+        Pool of long-lived connections, a connection is bound to one thread until it's released.
+        pragmas: applied once when a connection is opened, e.g. {'journal_mode': 'wal'}
+        """
+        self.pragmas = pragmas if pragmas is not None else dict()
+        self.max_idle = max_idle
+        self._idle = dict() # path -> idle connections
+        self._local = local()
+        self._lock = Lock()
+        self._pid = getpid()
+
+
+    def _connect(self, path:str) -> Connection:
+        """Open new connection and apply pragmas."""
+        conn = connect(path, check_same_thread=False, timeout=self.pragmas.get('busy_timeout', 5000) / 1000)
+        for key, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {key} = {value};')
+        log.debug(f'opened pooled connection to db: {path}')
+        return conn
+
+
+    def _bound(self) -> dict:
+        """Connections bound to the current thread."""
+        if self._pid != getpid(): # connections can't be shared with forked processes
+            self._idle = dict()
+            self._local = local()
+            self._lock = Lock()
+            self._pid = getpid()
+        try: return self._local.conns
+        except AttributeError:
+            self._local.conns = dict()
+            return self._local.conns
+
+
+    def acquire(self, path:str) -> Connection:
+        """Return connection of the current thread or take one from the pool."""
+        bound = self._bound()
+        if path not in bound:
+            with self._lock:
+                idle = self._idle.get(path)
+                conn = idle.pop() if idle else None
+            bound[path] = conn if conn is not None else self._connect(path)
+        return bound[path]
+
+
+    def release(self) -> None:
+        """Give connections of the current thread back to the pool."""
+        bound = self._bound()
+        for path, conn in bound.items():
+            try:
+                if conn.in_transaction: conn.rollback() # drop uncommitted changes like a closed connection would
+                with self._lock:
+                    idle = self._idle.setdefault(path, list())
+                    if len(idle) < self.max_idle:
+                        idle.append(conn)
+                        continue
+                conn.close()
+            except Exception as e:
+                log.error(f'error while releasing connection to db: {path}: {e.__str__()}')
+        bound.clear()
+
+
+    def close_all(self) -> None:
+        """Close idle connections and connections of the current thread."""
+        self.release()
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns: conn.close()
+            self._idle.clear()
+
+
+class Writer:
+    def __init__(self, window_ms:float = 2, max_batch:int = 64) -> None:
+        """
+        Thread owning the write connection of the process, writes are queued and committed in groups.
+        A group is collected for up to window_ms when writes are queued concurrently, a single write is committed right away.
+        Each write runs in its own savepoint. Every worker process has a writer of its own.
+        """
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._reset()
+        if register_at_fork is not None: register_at_fork(after_in_child=self._reset)
+
+
+    def _reset(self) -> None:
+        """Drop state inherited by a forked process, the lock may have been held and the thread isn't running there."""
+        self._lock = Lock()
+        self._queue = None
+        self._pid = None
+
+
+    def submit(self, path:str, func) -> Future:
+        """Queue func(cursor) to run in a transaction on db, the future is resolved after the commit."""
+        future = Future()
+        with self._lock:
+            if self._pid != getpid(): # start on first use
+                self._queue = SimpleQueue()
+                self._pid = getpid()
+                Thread(target=self._run, args=(self._queue,), name='sqlite-writer', daemon=True).start()
+            self._queue.put((path, func, future))
+        return future
+
+
+    def _run(self, queue:SimpleQueue) -> None:
+        """Take writes from queue and commit them in groups."""
+        conns = dict() # path -> write connection
+        while True:
+            batch = [queue.get()]
+            deadline = perf_counter() + self.window
+            while len(batch) < self.max_batch:
+                try: batch.append(queue.get_nowait() if len(batch) == 1 else queue.get(timeout=max(deadline - perf_counter(), 0)))
+                except Empty: break
+            for path in dict.fromkeys(job[0] for job in batch):
+                jobs = [job for job in batch if job[0] == path]
+                try:
+                    if path not in conns:
+                        conns[path] = pool._connect(path)
+                        conns[path].isolation_level = None # transactions are handled here
+                    self._commit(conns[path], jobs)
+                except Exception as e:
+                    log.error(f'error while committing writes to db: {path}: {e.__str__()}')
+                    for _, _, future in jobs: 
+                        if not future.done(): future.set_exception(e)
+
+
+    def _commit(self, conn:Connection, jobs:list) -> None:
+        """Run jobs in one transaction, a failing job only rolls back its own savepoint."""
+        cursor = conn.cursor()
+        results = []
+        cursor.execute('BEGIN IMMEDIATE;')
+        try:
+            for _, func, future in jobs:
+                cursor.execute('SAVEPOINT job;')
+                try: 
+                    results.append((future, func(cursor), None))
+                    cursor.execute('RELEASE job;')
+                except Exception as e:
+                    cursor.execute('ROLLBACK TO job;')
+                    cursor.execute('RELEASE job;')
+                    results.append((future, None, e))
+            cursor.execute('COMMIT;')
+        except Exception:
+            if conn.in_transaction: cursor.execute('ROLLBACK;')
+            raise
+        finally: cursor.close()
+        for future, result, exception in results: # only report committed writes
+            if exception is not None: future.set_exception(exception)
+            else: future.set_result(result)
+
+
+_queries = local() # queries of the current thread, for metrics
+
+
+def query_count(reset:bool = False) -> int:
+    """Return number of queries executed by the current thread, optionally start counting from zero again."""
+    count = getattr(_queries, 'count', 0)
+    if reset: _queries.count = 0
+    return count
+
+
+class QueryStats:
+    def __init__(self, slow_ms:float = 100, slow_log:str|None = None) -> None:
+        """
+        Count and time statements grouped by fingerprint (statement with literals replaced by ?).
+        Statements slower than slow_ms are written to slow_log with their query plan.
+        """
+        self.slow_ms = slow_ms
+        self.slow_log = slow_log
+        self._stats = dict() # fingerprint -> [count, total seconds, max seconds]
+        self._lock = Lock()
+
+
+    @staticmethod
+    @lru_cache(maxsize=2048)
+    def fingerprint(sql:str) -> str:
+        """Normalize statement by replacing literals and whitespace."""
+        sql = re.sub(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"", '?', sql) # strings, the code quotes them with " as well
+        sql = re.sub(r'\b\d+(?:\.\d+)?\b', '?', sql) # numbers
+        sql = re.sub(r'\(\s*\?(?:\s*,\s*\?)*\s*\)', '(?...)', sql) # value lists
+        return ' '.join(sql.split()).rstrip(';').strip()
+
+
+    def record(self, sql:str, seconds:float, conn:Connection|None = None, params:tuple = ()) -> None:
+        """Record executed statement, slow ones are logged with their query plan."""
+        key = self.fingerprint(sql)
+        with self._lock:
+            stats = self._stats.setdefault(key, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+        if seconds * 1000 >= self.slow_ms:
+            try: plan = '\n'.join(f'    {i[3]}' for i in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params)) if conn is not None else ''
+            except Exception: plan = ''
+            log.warning(f'slow query ({seconds * 1000:.1f} ms): {key}')
+            if self.slow_log is not None:
+                with self._lock, open(self.slow_log, 'a') as f:
+                    f.write(f'[{datetime.now().strftime("%d.%m.%Y|%H:%M:%S")}] {seconds * 1000:.1f} ms: {sql}\n' + (f'{plan}\n' if plan else ''))
+
+
+    def snapshot(self) -> dict:
+        """Return stats per fingerprint."""
+        with self._lock:
+            return {key: list(value) for key, value in self._stats.items()}
+
+
+    @staticmethod
+    def report(snapshots:list) -> str:
+        """Merge snapshots of several processes and format them as table ordered by total time."""
+        merged = dict()
+        for snapshot in snapshots:
+            for key, (count, total, highest) in snapshot.items():
+                stats = merged.setdefault(key, [0, 0.0, 0.0])
+                stats[0] += count
+                stats[1] += total
+                stats[2] = max(stats[2], highest)
+        lines = [f'{"count":>8} {"total ms":>10} {"avg ms":>8} {"max ms":>8}  statement']
+        for key, (count, total, highest) in sorted(merged.items(), key=lambda i: i[1][1], reverse=True):
+            lines.append(f'{count:>8} {total * 1000:>10.1f} {total * 1000 / count:>8.2f} {highest * 1000:>8.2f}  {key}')
+        return '\n'.join(lines)
+
+
+try:
+    query_stats = QueryStats(CONFIG.get('db').get('slow_query_ms', 100), CONFIG.get('db').get('slow_query_log'))
+except (NameError, AttributeError):
+    query_stats = QueryStats()
+
+
+try:
+    writer = Writer(
+        CONFIG.get('db').get('writer', {}).get('window_ms', 2),
+        CONFIG.get('db').get('writer', {}).get('max_batch', 64)
+    )
+except (NameError, AttributeError):
+    writer = Writer()
+
+
+try:
+    pool = Pool(
+        CONFIG.get('db').get('pragmas', {'journal_mode': 'wal', 'synchronous': 'normal', 'busy_timeout': 5000}),
+        CONFIG.get('db').get('pool', {}).get('max_idle', 8)
+    )
+except (NameError, AttributeError):
+    pool = Pool({'journal_mode': 'wal', 'synchronous': 'normal', 'busy_timeout': 5000})
+
+
 class DB:
     def __init__(self, path:str) -> None:
         self.path = path
 
         try:
-            self.conn = connect(path)
+            self.conn = pool.acquire(path)
             self.curser = self.conn.cursor()
         except Exception as e:
             log.critical(f'Failed to connect to DB: {e.__str__()}')
@@ -35,6 +294,8 @@ class DB:
             inp = input(f'{question} [y/n] ').lower()
 
             if inp == 'y':
+                for i in ('-wal', '-shm'): # journal of the old db
+                    if exists(db_path + i): remove(db_path + i)
                 with open(db_path, 'w') as f: 
                     f.close()
                 log.info(f'created new db: {db_path}')
@@ -42,6 +303,8 @@ class DB:
             else: 
                 return False
         else:
+            for i in ('-wal', '-shm'): # journal of the old db
+                if exists(db_path + i): remove(db_path + i)
             with open(db_path, 'w') as f: 
                 f.close()
             log.info(f'created new db: {db_path}')
@@ -51,8 +314,11 @@ class DB:
     def execute(self, sql:str, params:tuple=()) -> tuple|None:
         """Execute sql code."""
         try: 
-            log.debug(f'execute in db: {self.path}: {sql}')
+            if log.enabled('debug'): log.debug(f'execute in db: {self.path}: {sql}')
+            _queries.count = getattr(_queries, 'count', 0) + 1
+            start = perf_counter()
             out = tuple(self.curser.execute(sql, params))
+            query_stats.record(sql, perf_counter() - start, self.conn, params)
             if len(out) > 0: return out
             else: return None
 
@@ -91,22 +357,62 @@ class DB:
 
 
     def close(self) -> None:
-        """Close connection to DB."""
+        """Close cursor, the connection stays open in the pool."""
         try:
             self.commit() # just for safety
-            self.conn.close()
+            self.curser.close()
         except Exception as e:
             log.error(f'error while closing connection to db: {self.path}: {e.__str__()}')
             raise e
     
 
+    def transaction(self, func, commit:bool = True):
+        """
+        Run func(cursor) as write transaction and return its result.
+        Committed writes are handed to the writer thread, unless the connection has an open transaction they belong to.
+        commit: False to run func in the transaction of this connection without committing
+        """
+        if not commit: return func(self.curser)
+        if self.conn.in_transaction: # the writer would wait for the lock of this transaction
+            out = func(self.curser)
+            self.commit()
+            return out
+        return writer.submit(self.path, func).result()
+
+
+    def write(self, sql:str, params:tuple|list=(), many:bool = False, commit:bool = True) -> int:
+        """Execute write statement and return number of changed rows, see transaction."""
+        if log.enabled('debug'): log.debug(f'execute in db: {self.path}: {sql}')
+        _queries.count = getattr(_queries, 'count', 0) + 1
+        def run(cursor):
+            start = perf_counter()
+            if many: cursor.executemany(sql, params)
+            else: cursor.execute(sql, params)
+            query_stats.record(sql, perf_counter() - start, None if many else cursor.connection, () if many else params)
+            return cursor.rowcount
+        return self.transaction(run, commit)
+    
+
     def insert(self, table:str, data:dict) -> None:
         """Insert data into table."""
         try:
             q = ', '.join(f"{'? '*len(data)}".split()) # get values of data
             code = f"INSERT INTO {table} ({', '.join([key for key in data])}) VALUES ({q});" # insert values safely
-            self.execute(code, tuple(val for _, val in data.items()))
-            self.commit()
+            self.write(code, tuple(val for _, val in data.items()))
+        except Exception as e:
+            log.error(f'error while inserting data into table: {table} in db: {self.path}: {e.__str__()}')
+            raise e
+    
+
+    def insert_many(self, table:str, columns:tuple|list, rows:list, ignore:bool = False, commit:bool = True) -> int:
+        """
+        Insert rows in one transaction and return number of inserted rows.
+        ignore: skip rows violating unique constraints
+        commit: False to share the transaction with the following statements
+        """
+        try:
+            code = f"INSERT {'OR IGNORE ' if ignore else ''}INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))});"
+            return self.write(code, rows, many=True, commit=commit)
         except Exception as e:
             log.error(f'error while inserting data into table: {table} in db: {self.path}: {e.__str__()}')
             raise e
@@ -125,14 +431,13 @@ class DB:
             raise e
     
 
-    def delete(self, table:str, where:str, params:tuple=()) -> None:
+    def delete(self, table:str, where:str, params:tuple=()) -> int:
         """
-        Delete row in table where $where matches.
+        Delete row in table where $where matches and return number of deleted rows.
         example: where='WHERE uid = ...'
         """
         try:
-            self.execute(f'DELETE FROM {table} {where};', params)
-            self.commit()
+            return self.write(f'DELETE FROM {table} {where};', params)
         except Exception as e:
             log.error(f'error while deleting row in table: {table} in db: {self.path}: {e.__str__()}')
             raise e
@@ -145,8 +450,7 @@ class DB:
         """
         try:
             data = ', '.join((f'{key} = "{value}"' for key, value in data.items()))
-            self.execute(f'UPDATE {table} SET {data} {where};', params)
-            self.commit()
+            self.write(f'UPDATE {table} SET {data} {where};', params)
         except Exception as e:
             log.error(f'error while updating row in table: {table} in db: {self.path}: {e.__str__()}')
             raise e
@@ -0,0 +1,129 @@
+from src.logger import Logger
+from src.exception import JSONDecodeError
+from hashlib import sha1
+from os import makedirs, remove, replace, stat, stat_result, walk, listdir, getpid
+from os.path import exists
+from threading import get_ident
+import gzip
+
+log = Logger('StorageLog')
+
+try:
+    with open('./config.json', 'r') as f:
+        CONFIG:dict = __import__('json').load(f)
+except JSONDecodeError:
+    log.critical('failed to load config file')
+    exit(1)
+
+# update loglist
+log.remove_loglist(*CONFIG.get('log')['remove'])
+
+LEGACY_PATH = 'static/blogs' # flat layout of older versions
+
+
+class BlogStorage:
+    def __init__(self, root:str = 'data/blogs', depth:int = 2, compress:bool = False) -> None:
+        """
+        Blog files sharded by hash of the blog id into depth levels of directories, e.g. root/3f/a1/<blog_id>.md
+        compress: write new files gzip compressed, files of both formats can be read
+        """
+        self.root = root
+        self.depth = depth
+        self.compress = compress
+
+
+    def _path(self, blog_id:str, compressed:bool) -> str:
+        """Path of blog file."""
+        if not blog_id or '/' in blog_id or '\\' in blog_id or blog_id.startswith('.'): # never leave the root
+            raise FileNotFoundError(blog_id)
+        digest = sha1(blog_id.encode()).hexdigest()
+        shards = '/'.join(digest[i * 2:i * 2 + 2] for i in range(self.depth))
+        return f'{self.root}/{shards}/{blog_id}.md{".gz" if compressed else ""}'
+
+
+    def _candidates(self, blog_id:str) -> tuple:
+        """Possible paths of blog, the configured format first."""
+        return (self._path(blog_id, self.compress), self._path(blog_id, not self.compress), f'{LEGACY_PATH}/{blog_id}.md')
+
+
+    def _locate(self, blog_id:str) -> tuple:
+        """Return path and stat of blog file, raise FileNotFoundError if the blog doesn't exist."""
+        for path in self._candidates(blog_id):
+            try: return path, stat(path)
+            except FileNotFoundError: continue
+        raise FileNotFoundError(blog_id)
+
+
+    def exists(self, blog_id:str) -> bool:
+        """Check if blog exists."""
+        try: return bool(self._locate(blog_id))
+        except FileNotFoundError: return False
+
+
+    def stat(self, blog_id:str) -> stat_result:
+        """Return stat of blog file, raise FileNotFoundError if the blog doesn't exist."""
+        return self._locate(blog_id)[1]
+
+
+    def read(self, blog_id:str) -> str:
+        """Return markdown of blog, raise FileNotFoundError if the blog doesn't exist."""
+        for path in self._candidates(blog_id):
+            try:
+                with (gzip.open(path, 'rt') if path.endswith('.gz') else open(path, 'r')) as f:
+                    return f.read()
+            except FileNotFoundError: continue
+        raise FileNotFoundError(blog_id)
+
+
+    def write(self, blog_id:str, text:str) -> None:
+        """Write blog atomically, readers see either the old or the new version."""
+        path = self._path(blog_id, self.compress)
+        makedirs(path.rsplit('/', 1)[0], exist_ok=True)
+        tmp = f'{path}.{getpid()}.{get_ident()}.tmp'
+        with (gzip.open(tmp, 'wt') if self.compress else open(tmp, 'w')) as f:
+            f.write(text)
+        replace(tmp, path)
+        # old versions in the other format or layout
+        for old in self._candidates(blog_id)[1:]:
+            try: remove(old)
+            except FileNotFoundError: continue
+
+
+    def delete(self, blog_id:str) -> bool:
+        """Delete blog file. Returns True if a file was deleted."""
+        deleted = False
+        for path in self._candidates(blog_id):
+            try: 
+                remove(path)
+                deleted = True
+            except FileNotFoundError: continue
+        return deleted
+
+
+    def list(self):
+        """Yield ids of all stored blogs."""
+        for _, _, files in walk(self.root):
+            for file in files:
+                if file.endswith('.md'): yield file.removesuffix('.md')
+                elif file.endswith('.md.gz'): yield file.removesuffix('.md.gz')
+
+
+    def migrate_legacy(self) -> int:
+        """Move blogs of the flat layout into the storage. Returns number of moved blogs."""
+        if not exists(LEGACY_PATH): return 0
+        moved = 0
+        for file in listdir(LEGACY_PATH):
+            if not file.endswith('.md'): continue
+            blog_id = file.removesuffix('.md')
+            with open(f'{LEGACY_PATH}/{file}', 'r') as f:
+                self.write(blog_id, f.read()) # also removes the old file
+            moved += 1
+        log.info(f'moved {moved} blogs into: {self.root}')
+        return moved
+
+
+storage = BlogStorage(
+    CONFIG.get('storage', {}).get('path', 'data/blogs'),
+    CONFIG.get('storage', {}).get('depth', 2),
+    CONFIG.get('storage', {}).get('compress', False)
+)
@@ -0,0 +1,28 @@
+from os.path import abspath, dirname, exists, join
+from json import load
+import subprocess
+import sys
+
+APP_DIR = dirname(dirname(abspath(__file__)))
+ARGS = ('--users', '4', '--sessions', '2', '--blogs', '10', '--words', '20', '--requests', '5', '--mode', 'client', '--rounds', '4', '--scenarios', 'explore_random', 'profile')
+
+
+def run_benchmark(cwd:str, *args:str) -> subprocess.CompletedProcess:
+    """Run the benchmark from cwd with the app on the path."""
+    return subprocess.run(
+        (sys.executable, '-m', 'benchmark') + ARGS + args, cwd=cwd, capture_output=True, text=True, timeout=300,
+        env={'PYTHONPATH': APP_DIR, 'PATH': ''}
+    )
+
+
+def test_save_and_compare_relative_baseline(tmp_path):
+    """A relative --save file outlives the temporary setup and can be used as --baseline of the next run."""
+    saved = run_benchmark(tmp_path, '--save', 'baseline.json')
+    assert saved.returncode == 0, saved.stdout + saved.stderr
+    assert exists(join(tmp_path, 'baseline.json'))
+    with open(join(tmp_path, 'baseline.json'), 'r') as f:
+        assert set(load(f)['client']) == {'explore_random', 'profile'}
+
+    compared = run_benchmark(tmp_path, '--baseline', 'baseline.json', '--tolerance', '1000')
+    assert compared.returncode == 0, compared.stdout + compared.stderr
+    assert 'no regressions against baseline' in compared.stdout